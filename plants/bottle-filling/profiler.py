@@ -0,0 +1,125 @@
+import time
+import numpy as np
+import pygame
+
+# Phases of a world frame, in order. The plant phases run once per physics
+# substep and add up over the frame.
+PROFILE_PHASES = ("events", "plc read", "logic", "spawn", "balls", "plc write",
+                  "cull", "space.step", "draw", "overlay", "flip")
+PROFILE_WINDOW  = 300           # Frames in the rolling histograms
+PROFILE_REFRESH = 0.5           # Seconds between two renders of the overlay
+
+# Histogram bin edges (s), the last bin holds everything over 30 ms
+PROFILE_BINS = np.array([0.0, 10e-6, 30e-6, 100e-6, 300e-6, 1e-3, 3e-3, 10e-3, 30e-3, np.inf])
+
+class FrameProfiler:
+    """ Time spent in each phase of the frames, over the last `window` frames.
+
+    The frame loop calls begin() once a frame, lap(phase) at the end of each
+    phase, charging it the time since the previous lap, then end(). A
+    summary line is printed every `interval` seconds, never if 0 or None.
+    """
+    def __init__(self, window=PROFILE_WINDOW, interval=5.0):
+        self.index = {phase: i for i, phase in enumerate(PROFILE_PHASES)}
+        self.window = window
+        self.interval = interval
+        self.times = np.zeros((window, len(PROFILE_PHASES)))
+        self.current = [0.0] * len(PROFILE_PHASES)
+        self.frames = 0
+        self.last = time.perf_counter()
+        self.reported = self.last
+
+        self.font = None
+        self.overlay = None
+        self.rendered = 0.0
+
+    def begin(self):
+        self.current = [0.0] * len(PROFILE_PHASES)
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.current[self.index[phase]] += now - self.last
+        self.last = now
+
+    def end(self):
+        self.times[self.frames % self.window] = self.current
+        self.frames += 1
+        if ( self.interval and self.last - self.reported >= self.interval ):
+            self.reported = self.last
+            print(self.line(), flush=True)
+
+    def recent(self):
+        """ Phase times (s) of the frames in the window, one row per frame. """
+        return self.times[:min(self.frames, self.window)]
+
+    def stats(self):
+        """ Mean, p95 and max of each phase and of the whole frame (s). """
+        times = self.recent()
+        if ( not len(times) ):
+            return None
+        times = np.column_stack((times, times.sum(axis=1)))
+        return times.mean(axis=0), np.percentile(times, 95, axis=0), times.max(axis=0)
+
+    def histograms(self):
+        """ Frame counts of each phase in the PROFILE_BINS, one row per phase. """
+        times = self.recent()
+        bins = np.searchsorted(PROFILE_BINS, times, side="right") - 1
+        counts = np.zeros((len(PROFILE_PHASES), len(PROFILE_BINS) - 1), dtype=np.int64)
+        for phase in range(len(PROFILE_PHASES)):
+            counts[phase] = np.bincount(bins[:, phase], minlength=len(PROFILE_BINS) - 1)
+        return counts
+
+    def line(self):
+        stats = self.stats()
+        if ( stats is None ):
+            return "profile: no frames"
+        mean, p95, _ = stats
+        phases = ", ".join(f"{phase} {mean[i] * 1e3:.2f}/{p95[i] * 1e3:.2f}"
+                           for i, phase in enumerate(PROFILE_PHASES))
+        return (f"profile ({len(self.recent())} frames, mean/p95 ms): {phases}, "
+                f"frame {mean[-1] * 1e3:.2f}/{p95[-1] * 1e3:.2f}")
+
+    def render(self):
+        """ Table of the phase stats, each row with its histogram. """
+        if ( self.font is None ):
+            self.font = pygame.font.SysFont(None, 16)
+        font = self.font
+        row = font.get_linesize()
+        bar = 5
+        columns = (5, 70, 110, 150)
+        histogram_x = 195
+        label = font.render("10us-30ms", 1, (200, 200, 200))
+        width = histogram_x + max(bar * (len(PROFILE_BINS) - 1), label.get_width()) + 5
+        surface = pygame.Surface((width, row * (len(PROFILE_PHASES) + 2) + 6), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 170))
+
+        for x, text in zip(columns, ("phase", "mean", "p95", "max ms")):
+            surface.blit(font.render(text, 1, (200, 200, 200)), (x, 3))
+        surface.blit(label, (histogram_x, 3))
+
+        stats = self.stats()
+        if ( stats is None ):
+            return surface
+        counts = self.histograms()
+        frames = max(len(self.recent()), 1)
+        for i, phase in enumerate(PROFILE_PHASES + ("frame",)):
+            y = 3 + row * (i + 1)
+            cells = (phase,) + tuple(f"{stat[i] * 1e3:.2f}" for stat in stats)
+            for x, text in zip(columns, cells):
+                surface.blit(font.render(text, 1, (255, 255, 255)), (x, y))
+            if ( i == len(PROFILE_PHASES) ):
+                continue
+            for b, count in enumerate(counts[i]):
+                height = round((row - 2) * count / frames)
+                if ( height ):
+                    pygame.draw.rect(surface, (80, 200, 120), (histogram_x + b * bar, y + row - 1 - height, bar - 1, height))
+        return surface
+
+    def draw(self, screen, top=10):
+        """ Blit the overlay on the right of the screen, rendered again every
+        PROFILE_REFRESH seconds. Returns the rect drawn on. """
+        if ( self.overlay is None or self.last - self.rendered >= PROFILE_REFRESH ):
+            self.overlay = self.render().convert_alpha()
+            self.rendered = self.last
+        return screen.blit(self.overlay, (screen.get_width() - self.overlay.get_width() - 10, top))
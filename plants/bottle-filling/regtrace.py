@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import sys
+import json
+import struct
+
+TRACE_MAGIC   = "virtuaplant-trace"
+TRACE_VERSION = 1
+TRACE_END     = 0xFF                # Register of the end-of-trace record
+TRACE_WIDTH   = 0xFE                # Window resizes, the world depends on its width
+TRACE_HEIGHT  = 0xFD
+
+# One record per register change: simulation tick, register, value
+RECORD = struct.Struct("<IBH")
+
+class TraceWriter:
+    """ Records the external register writes a plant sees.
+
+    The plant only reads its registers at the start of a scan, so writes
+    from Modbus clients are recorded as the registers that differ from the
+    image the plant committed at the end of the previous scan, tagged with
+    the tick of the scan that sees them. Replaying those changes before the
+    same ticks reproduces the run exactly.
+
+    Window resizes are recorded too, as they move the conveyor wheels.
+    The file is a JSON header line followed by packed records.
+    """
+    def __init__(self, path, header):
+        self.file = open(path, "wb")
+        self.file.write((json.dumps(dict(header, magic=TRACE_MAGIC, version=TRACE_VERSION)) + "\n").encode())
+        self.records = 0
+        self.tick = 0
+        self.size = None
+
+    def record(self, tick, snapshot, previous):
+        self.tick = tick
+        if ( snapshot == previous ):
+            return
+        for addr, value in enumerate(snapshot):
+            if ( value != previous[addr] ):
+                self.file.write(RECORD.pack(tick, addr, value))
+                self.records += 1
+
+    def resize(self, tick, width, height):
+        if ( (width, height) != self.size ):
+            self.size = (width, height)
+            self.file.write(RECORD.pack(tick, TRACE_WIDTH, width) + RECORD.pack(tick, TRACE_HEIGHT, height))
+
+    def close(self):
+        # The end record keeps the length of the run, writes or not
+        self.file.write(RECORD.pack(self.tick + 1, TRACE_END, 0))
+        self.file.close()
+
+def read_trace(path):
+    """ (header, [(tick, register, value), ...]) of a trace file. """
+    with open(path, "rb") as trace:
+        header = json.loads(trace.readline())
+        data = trace.read()
+
+    if ( header.get("magic") != TRACE_MAGIC or header.get("version") != TRACE_VERSION ):
+        raise ValueError(f"{path} is not a version {TRACE_VERSION} register trace")
+    return header, list(RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size]))
+
+def main():
+    # Dump a trace as text
+    header, records = read_trace(sys.argv[1])
+    print(json.dumps(header))
+    for tick, addr, value in records:
+        names = {TRACE_END: "end", TRACE_WIDTH: "width", TRACE_HEIGHT: "height"}
+        print(tick, names.get(addr, addr), value)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
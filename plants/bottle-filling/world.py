@@ -10,13 +10,19 @@ import random
 import pygame
 import logging
 import argparse
+import bisect
 import getopt
 import pymunk
-from datetime import datetime, timedelta
+import pymunk.batch
+import numpy as np
+from collections import deque
 from pygame.locals import *
 from pygame.color import THECOLORS
 
 from modbus import ServerModbus as Server
+from regtrace import TraceWriter, read_trace, TRACE_END, TRACE_WIDTH, TRACE_HEIGHT
+from historian import Historian
+from profiler import FrameProfiler
 
 from modbus import (
     REG_RUN,
@@ -27,17 +33,31 @@ from modbus import (
     REG_NOZZLE,
     REG_THROUGHPUT,
     REG_COLOR,
+    REG_COUNT,
+    REG_BLOCK_SIZE,
     MODBUS_PORT,
 )
 from modbus import COLORS
 
 dark_mode   = False
 hide_title  = False
+dirty_rects = False
 debug       = False
+headless    = False
 
 # Physic world parameters
 speed               = 1.0
-FPS                 = 30.0
+FPS                 = 30.0      # Display rate
+physics_rate        = 30.0      # Fixed physics/PLC rate (steps per second)
+max_substeps        = 5         # Catch-up cap per frame
+MAX_FRAME_TIME      = 0.25      # Longest frame fed to the accumulator (s)
+time_scale          = 1.0       # Simulated seconds per wall second, 0 = as fast as possible
+duration            = None      # Simulated seconds to run, None = forever
+recorder            = None      # TraceWriter of the external register writes
+historian           = None      # Historian sampling the register block each scan
+profiler            = None      # FrameProfiler timing the phases of each frame
+profile_overlay     = False     # Show the profiler overlay (F3 toggles it)
+nozzle_rate         = 30.0      # Balls per second per throughput unit
 bottle_thickness    = 7
 ball_radius         = 3
 NEXT_BOTTLE_DISTANCE = 100
@@ -62,21 +82,27 @@ sensor_x = WORLD_SCREEN_WIDTH // 3.58
 sensor_y = WORLD_SCREEN_HEIGHT // 1.66
 sensor_radius = 10
 
+ball_pool_size = 1000
+
+# Aggregated fill model
+fill_model = "balls"            # "balls" (one body per drop) or "volume"
+fill_fall_time = 0.45           # Time for a drop to fall from the nozzle (s)
+fill_ball_area = 24.0           # Bottle area filled per ball, calibrated against the ball model
+fill_inner_width = 50 - 2 * bottle_thickness
+fill_particles = 6              # Cosmetic drops drawn under the open nozzle
+
 wheel_radius = 17
 wheel_y = 280
-wheels = []
-wheel_angles = []
-wheel_rotation_speed = 0.05
-conveyor_line_offset = 0.0
+wheel_rotation_speed = 1.5     # rad/s
+wheel_sprite_steps = 30         # Pre-rendered rotation steps per spoke interval
+wheel_sprites = {}              # (scale, dark_mode) -> wheel images, current key only
+WHEEL_SPOKE_ANGLE = 2 * math.pi / 6
+conveyor_line_speed = 30.0      # px/s per motor speed unit
 
 # Logging
 logging.basicConfig()
 log = logging.getLogger()
 
-# Globals
-bottles         = []
-conveyor        = None
-
 def get_theme_colors():
     if dark_mode:
         return {
@@ -102,16 +128,56 @@ def get_theme_colors():
 def to_pygame(p, scale=1.0):
     return int(p.x * scale), int((-p.y + 600) * scale)
 
-def add_ball(space, color):
+class BallPool:
+    """ Bounded pool of ball shapes recycled between nozzle drops.
+
+    A hit reuses a preallocated body/shape, a miss (pool empty) allocates a
+    new one. Released balls beyond the pool size are left to the garbage
+    collector.
+    """
+    def __init__(self, size=ball_pool_size):
+        self.size = size
+        self.free = [self.new_ball() for _ in range(size)]
+        self.hits = 0
+        self.misses = 0
+
+    def new_ball(self):
+        body = pymunk.Body(1, 1)
+        return pymunk.Circle(body, ball_radius, (0, 0))
+
+    def acquire(self):
+        if self.free:
+            self.hits += 1
+            return self.free.pop()
+        self.misses += 1
+        return self.new_ball()
+
+    def release(self, shapes):
+        room = self.size - len(self.free)
+        if room > 0:
+            self.free.extend(shapes[:room])
+
+def add_ball(space, color, pool=None):
     mass = 0.1 + 0.1 * color
     radius = ball_radius
     inertia = pymunk.moment_for_circle(mass, 0, radius, (0, 0))
     x = random.randint(180, 183)
 
-    body = pymunk.Body(mass, inertia)
+    if pool:
+        shape = pool.acquire()
+        body = shape.body
+        body.mass = mass
+        body.moment = inertia
+        body.angle = 0
+        body.velocity = (0, 0)
+        body.angular_velocity = 0
+        body.force = (0, 0)
+        body.torque = 0
+    else:
+        body = pymunk.Body(mass, inertia)
+        shape = pymunk.Circle(body, radius, (0, 0))
     body.position = x, 430
 
-    shape = pymunk.Circle(body, radius, (0, 0))
     space.add(body, shape)
     return shape
 
@@ -120,9 +186,16 @@ def draw_polygon(screen, shape, scale=1.0, color=THECOLORS['black']):
     points = [to_pygame(v.rotated(shape.body.angle) + shape.body.position, scale) for v in vertices]
     pygame.draw.polygon(screen, color, points)
 
+def union_rects(rects):
+    """ Bounding rect of the non-empty rects, or None. """
+    rects = [rect for rect in rects if rect and rect.width and rect.height]
+    if not rects:
+        return None
+    return rects[0].unionall(rects[1:])
+
 def draw_ball(screen, ball, scale=1.0, color=THECOLORS['blue']):
     p = to_pygame(ball.body.position, scale)
-    pygame.draw.circle(screen, color, p, max(1, int(ball.radius * scale)), 0)
+    return pygame.draw.circle(screen, color, p, max(1, int(ball.radius * scale)), 0)
 
 def add_bottle(space):
     mass = 5
@@ -148,6 +221,7 @@ def add_bottle(space):
     return l1, l2, l3
 
 def draw_lines(screen, lines, scale=1.0, color=THECOLORS['dodgerblue4']):
+    rects = []
     for line in lines:
         body = line.body
         x = body.position.x
@@ -165,7 +239,8 @@ def draw_lines(screen, lines, scale=1.0, color=THECOLORS['dodgerblue4']):
         pv2 = body.position + line.b.rotated(body.angle)
         p1 = to_pygame(pv1, scale)
         p2 = to_pygame(pv2, scale)
-        pygame.draw.lines(screen, partial_color, False, [p1, p2], bottle_thickness*int(scale))
+        rects.append(pygame.draw.lines(screen, partial_color, False, [p1, p2], bottle_thickness*int(scale)))
+    return union_rects(rects)
 
 def add_polygon(space, pos, size, collision_type):
     body = pymunk.Body(body_type=pymunk.Body.STATIC)
@@ -231,21 +306,18 @@ def add_laser(screen, scale):
         line_width,
         line_height
     )
-    pygame.draw.rect(screen, colors["sensor"], line_rect)
+    line_rect = pygame.draw.rect(screen, colors["sensor"], line_rect)
 
     ball_color = (255, 0, 0)
     ball_radius = 3 * scale
     ball_center_x = (nozzle_center_x - 32) * scale + 25 * scale + ball_radius + -23 * scale
     ball_center_y = (598 - nozzle_top_y + 6) * scale + 7 * scale / 2
-    pygame.draw.circle(screen, ball_color, (int(ball_center_x), int(ball_center_y)), int(ball_radius))
-
-def add_conveyor(screen, space, window_width, scale, motor_state):
+    ball_rect = pygame.draw.circle(screen, ball_color, (int(ball_center_x), int(ball_center_y)), int(ball_radius))
+    return union_rects([line_rect, ball_rect])
 
-    global wheel_angles
-    global conveyor_line_offset
-    global conveyor
+def add_conveyor(screen, plant, scale):
 
-    draw_polygon(screen, conveyor, scale, color=colors["polygon"])
+    conveyor = plant.conveyor
 
     line_color = colors["line"]
     line_width = max(1, int(3 * scale))
@@ -253,51 +325,67 @@ def add_conveyor(screen, space, window_width, scale, motor_state):
     conveyor_rect_bottom_y = (600 - 300 + 4) * scale
     conveyor_width = conveyor.bb.right - conveyor.bb.left
 
-    line_scroll_speed = speed if motor_state else 0.0
-    conveyor_line_offset += line_scroll_speed
     spacing_px = 70
-    if conveyor_line_offset >= spacing_px:
-        conveyor_line_offset -= spacing_px
-
     num_lines = int(conveyor_width / spacing_px) + 2
+    rects = []
     for i in range(num_lines):
-        x = conveyor.bb.left + (i * spacing_px) + conveyor_line_offset 
+        x = conveyor.bb.left + (i * spacing_px) + plant.conveyor_line_offset 
         screen_x = int(x * scale) 
         screen_y_start = int(conveyor_rect_bottom_y - line_height) 
 
-        pygame.draw.line(
+        rects.append(pygame.draw.line(
             screen,
             line_color,
             (screen_x, screen_y_start),
             (screen_x, screen_y_start + line_height),
             line_width
-        )
+        ))
+    rects = [union_rects(rects)]
 
 
-    for idx, wheel in enumerate(wheels):
+    sprites = get_wheel_sprites(scale)
+    for idx, wheel in enumerate(plant.wheels):
         center = to_pygame(wheel.body.position, scale)
-        radius = int(wheel.radius * scale)
-
-        if motor_state:
-            wheel_angles[idx] += wheel_rotation_speed
-
-        border_color = THECOLORS["gray"] if dark_mode else THECOLORS["white"]
-        pygame.draw.circle(screen, border_color, center, radius + 2)
-
-        pygame.draw.circle(screen, THECOLORS["black"], center, radius)
-
-        for s in range(6):
-            angle = wheel_angles[idx] + (2 * math.pi * s / 6)
-            end_x = center[0] + radius * 0.7 * math.cos(angle)
-            end_y = center[1] + radius * 0.7 * math.sin(angle)
-            pygame.draw.line(screen, THECOLORS["gray70"], center, (int(end_x), int(end_y)), 2)
-
-        pygame.draw.circle(screen, THECOLORS["black"], center, radius, 2)
-
-    # Draw wheels
-    update_wheels(space, wheels, window_width, wheel_y, wheel_radius)
-    if len(wheel_angles) != len(wheels):
-        wheel_angles = [0.0 for _ in wheels]
+        step = int((plant.wheel_angles[idx] % WHEEL_SPOKE_ANGLE) / WHEEL_SPOKE_ANGLE * wheel_sprite_steps) % wheel_sprite_steps
+        sprite = sprites[step]
+        rects.append(screen.blit(sprite, (center[0] - sprite.get_width() // 2, center[1] - sprite.get_height() // 2)))
+
+    return rects
+
+def get_wheel_sprites(scale):
+    """ Wheel images for each rotation step, rendered once per scale and theme.
+
+    The six spokes repeat every WHEEL_SPOKE_ANGLE, so the steps only need to
+    cover that angle. Only the images of the current scale and theme are
+    kept, so resizing the window does not pile up old ones.
+    """
+    key = (scale, dark_mode)
+    sprites = wheel_sprites.get(key)
+    if sprites is None:
+        sprites = [draw_wheel(scale, WHEEL_SPOKE_ANGLE * step / wheel_sprite_steps) for step in range(wheel_sprite_steps)]
+        wheel_sprites.clear()
+        wheel_sprites[key] = sprites
+    return sprites
+
+def draw_wheel(scale, wheel_angle):
+    radius = int(wheel_radius * scale)
+    size = 2 * (radius + 2) + 1
+    center = (radius + 2, radius + 2)
+    sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+
+    border_color = THECOLORS["gray"] if dark_mode else THECOLORS["white"]
+    pygame.draw.circle(sprite, border_color, center, radius + 2)
+
+    pygame.draw.circle(sprite, THECOLORS["black"], center, radius)
+
+    for s in range(6):
+        angle = wheel_angle + (2 * math.pi * s / 6)
+        end_x = center[0] + radius * 0.7 * math.cos(angle)
+        end_y = center[1] + radius * 0.7 * math.sin(angle)
+        pygame.draw.line(sprite, THECOLORS["gray70"], center, (int(end_x), int(end_y)), 2)
+
+    pygame.draw.circle(sprite, THECOLORS["black"], center, radius, 2)
+    return sprite
 
 def run_servers():
     def start_server(obj):
@@ -305,18 +393,76 @@ def run_servers():
 
     threading.Thread(target=start_server, args=(plc,), daemon=True).start()
 
-def is_sensor_touching_bottle(sensor_x, sensor_y, sensor_radius, bottles):
-
-    for bottle in bottles:
-        left_segment = bottle[1]  
-        body = left_segment.body
-        world_a = body.position + left_segment.a.rotated(body.angle)
-        ax, _ = to_pygame(world_a)
+class BottleIndex:
+    """ Bottles in spawn order, indexed by x for bisection queries.
+
+    Bottles are kinematic, spawn at the same place and ride the conveyor
+    together, so the list is always sorted by decreasing x. Each bottle gets
+    a conveyor coordinate when appended; the current conveyor travel is
+    recovered from the newest bottle's position.
+
+    A bottle spawned after the conveyor velocities were set stands still
+    during its first physics step while the others move, see stepped().
+    """
+    def __init__(self, bottles=()):
+        self.bottles = []
+        self.keys = []      # Negated conveyor coordinates, ascending
+        self.lagging = False
+        for bottle in bottles:
+            self.append(bottle)
+
+    def __iter__(self):
+        return iter(self.bottles)
+
+    def __len__(self):
+        return len(self.bottles)
+
+    def __getitem__(self, index):
+        return self.bottles[index]
+
+    def travel(self):
+        return self.bottles[-1][0].body.position.x + self.keys[-1]
+
+    def append(self, bottle):
+        travel = self.travel() if self.bottles else 0.0
+        self.bottles.append(bottle)
+        self.keys.append(travel - bottle[0].body.position.x)
+        self.lagging = len(self.bottles) > 1
+
+    def stepped(self):
+        """ After a physics step: the newest bottle stood still during the
+        step that followed its spawn, its key is rebased on the previous
+        bottle. """
+        if ( self.lagging and len(self.bottles) > 1 ):
+            travel = self.bottles[-2][0].body.position.x + self.keys[-2]
+            self.keys[-1] = travel - self.bottles[-1][0].body.position.x
+        self.lagging = False
+
+    def remove(self, bottle):
+        index = self.bottles.index(bottle)
+        del self.bottles[index]
+        del self.keys[index]
+
+    def find(self, low, high):
+        """ First bottle with its body x in [low, high), or None. """
+        if not self.bottles:
+            return None
+        index = bisect.bisect_right(self.keys, self.travel() - high)
+
+        # Keys are only exact up to rounding, check the neighbours on the
+        # real body positions
+        for bottle in self.bottles[max(0, index - 1):index + 2]:
+            if low <= bottle[0].body.position.x < high:
+                return bottle
+        return None
 
-        if abs(sensor_x - ax) <= sensor_radius:
-            return True
+def is_sensor_touching_bottle(sensor_x, sensor_y, sensor_radius, bottles):
 
-    return False
+    # Bottle left side (segment a at x - 150) within sensor_radius of the
+    # sensor, once truncated to screen pixels as to_pygame does
+    low = math.ceil(sensor_x - sensor_radius) + 150
+    high = math.floor(sensor_x + sensor_radius) + 1 + 150
+    return bottles.find(low, high) is not None
 
 def add_level_sensor(screen, scale):
     rect_x = (level_sensor_x) * scale
@@ -356,60 +502,535 @@ def update_wheels(space, wheels, window_width, wheel_y, wheel_radius):
 
         wheels.append(wheel_shape)
 
+class Plant:
+    """ Bottle-filling plant: pymunk world plus the PLC programm driving it.
+
+    The plant can be stepped on its own (headless) or drawn on a pygame
+    screen after each step.
+    """
+    def __init__(self, plc, autorun=False, unit=0x0, recorder=None, historian=None, profiler=None):
+        self.plc = plc
+        self.unit = unit
+        self.recorder = recorder
+        self.historian = historian
+        self.profiler = profiler
+        self.last_image = [0] * REG_COUNT
+        # The historian samples the whole register block, read with the process image
+        self.scan_size = REG_BLOCK_SIZE if historian else REG_COUNT
+
+        self.space = pymunk.Space()
+        self.space.use_spatial_hash(ball_radius, 10000)
+        self.space.gravity = (0.0, -900.0)
+
+        self.nozzle_actuator = add_polygon(self.space, (181, 450), (15, 20), 0x9)
+        self.conveyor = None
+        self.scale = None
+        self.window_width = WORLD_SCREEN_WIDTH
+        self.bottles = BottleIndex([add_bottle(self.space)])
+        self.balls = []
+        self.ball_pool = BallPool()
+        self.ball_ids = np.zeros(0, dtype=np.uintp)
+        self.batch = pymunk.batch.Buffer()
+        self.in_flight = deque()
+        self.fill = {}
+        self.wheels = []
+        self.wheel_angles = []
+        self.conveyor_line_offset = 0.0
+        self.accumulator = 0.0
+        self.pour = 0.0
+        self.scan_time = 0.0
+        self.scan_time_total = 0.0
+        self.scan_time_max = 0.0
+        self.logic_time = 0.0
+        self.step_time = 0.0
+
+        self.sim_time = 0.0
+        self.steps = 0
+        # Compared on steps, the summed float sim_time drifts past the last step
+        self.end_step = None if duration is None else round(duration * physics_rate)
+        self.now = 0.0
+        self.now_previous = 0.0
+        self.bottle_per_min = 0
+        self.bottles_filled = 0
+
+        self.level_sensor = 0
+        self.flag_sensor_level = False
+        self.contact = 0
+        self.nozzle = 0
+        self.motor = 0
+        self.speed = speed
+        self.throughput = nozzle_throughput
+        self.nextColor = 0
+        self.currentColor = 0
+        self.run = autorun
+
+        self.plc.write(REG_RUN, autorun, unit=self.unit)
+
+    def resize(self, window_width, scale):
+        if ( window_width != self.window_width or not self.wheels ):
+            update_wheels(self.space, self.wheels, window_width, wheel_y, wheel_radius)
+            if len(self.wheel_angles) != len(self.wheels):
+                self.wheel_angles = [0.0 for _ in self.wheels]
+        self.window_width = window_width
+        conveyor_width = window_width / scale
+        if ( self.conveyor == None ):
+            self.conveyor = add_polygon(self.space, (conveyor_width / 2, 300), (conveyor_width, 20), 0x7)
+        elif (scale != self.scale):
+            self.space.remove(self.conveyor)
+            self.conveyor = add_polygon(self.space, (conveyor_width / 2, 300), (conveyor_width, 20), 0x7)
+        self.scale = scale
+
+    def advance(self, elapsed):
+        """ Feed elapsed wall time (s) to the plant in fixed physics steps.
+
+        Wall time is converted to simulated time with time_scale. At most
+        max_substeps (per unit of time scale) are run; time that could not
+        be caught up is dropped so that a slow frame does not snowball into
+        slower ones.
+        """
+        dt = 1 / physics_rate
+        self.accumulator += min(elapsed, MAX_FRAME_TIME) * time_scale
+        max_steps = max_substeps * max(1, math.ceil(time_scale))
+
+        steps = 0
+        while self.accumulator >= dt and steps < max_steps:
+            self.step(dt)
+            self.accumulator -= dt
+            steps += 1
+
+        if self.accumulator >= dt:
+            self.accumulator %= dt
+
+        return steps
+
+    def commit(self, image):
+        """ Write the PLC outputs of the process image back: the motor
+        register and the nozzle..level run, one bulk write each. The inputs
+        (run, speed, throughput, color) belong to the HMI and other clients,
+        writing them back would undo their writes made during the scan.
+        """
+        self.plc.writeln(REG_MOTOR_EN, image[REG_MOTOR_EN:REG_MOTOR_EN + 1], unit=self.unit)
+        self.plc.writeln(REG_NOZZLE, image[REG_NOZZLE:REG_LEVEL + 1], unit=self.unit)
+
+    def step(self, dt=None):
+        dt = dt or 1 / physics_rate
+        plc = self.plc
+        space = self.space
+        bottles = self.bottles
+        balls = self.balls
+        profiler = self.profiler
+
+        # PLC scan: snapshot all registers into the process image
+        scan_start = time.perf_counter()
+        snapshot = plc.readln(0, self.scan_size, unit=self.unit)
+        image = snapshot[:REG_COUNT]
+        if ( self.recorder ):
+            self.recorder.record(self.steps, image, self.last_image)
+        if ( profiler ):
+            profiler.lap("plc read")
+
+        self.run = image[REG_RUN]
+        self.motor = image[REG_MOTOR_EN]
+        self.speed = image[REG_MOTOR_SPEED]
+        self.nozzle = image[REG_NOZZLE]
+        self.contact = image[REG_CONTACT]
+        self.level_sensor = image[REG_LEVEL]
+        self.throughput = image[REG_THROUGHPUT]
+        self.nextColor = image[REG_COLOR]
+
+        run = self.run
+        contact = self.contact
+        level_sensor = self.level_sensor
+
+        # Manage PLC programm
+        logic_start = time.perf_counter()
+        # Motor Logic
+        if (run == 1) and ((contact == 0) or (level_sensor == 1)):
+            image[REG_MOTOR_EN] = 1
+        else:
+            image[REG_MOTOR_EN] = 0
+
+        # Nozzle Logic
+        if (run == 1) and ((contact == 1) and (level_sensor == 0)):
+            image[REG_NOZZLE] = 1
+        else:
+            image[REG_NOZZLE] = 0
+
+        if is_sensor_touching_bottle(sensor_x, sensor_y, sensor_radius, bottles):
+            image[REG_CONTACT] = 1
+        else:
+            self.flag_sensor_level=False
+            image[REG_CONTACT] = 0
+
+        logic_end = time.perf_counter()
+        self.logic_time = logic_end - logic_start
+        scan_time = logic_end - scan_start
+        if ( profiler ):
+            profiler.lap("logic")
+
+        # Handle world inputs
+        if self.nozzle:
+            if bottles:
+                self.pour += self.throughput * nozzle_rate * dt
+                poured = int(self.pour)
+                self.pour -= poured
+                if ( fill_model == "volume" ):
+                    if poured:
+                        self.in_flight.append((self.sim_time + fill_fall_time, poured, self.currentColor))
+                elif poured:
+                    new_ids = []
+                    for i in range(poured):
+                        ball = add_ball(space, self.currentColor, self.ball_pool)
+                        balls.append((ball, bottles[-1][0].body, self.currentColor))
+                        new_ids.append(ball.body.id)
+                    self.ball_ids = np.append(self.ball_ids, np.array(new_ids, dtype=np.uintp))
+        elif run:
+            self.currentColor = self.nextColor
+
+        if self.motor:
+            # Move bottle
+            for bottle in bottles:
+                bottle[0].body.velocity = (20*self.speed, 0)
+        else:
+            for bottle in bottles:
+                bottle[0].body.velocity = (0, 0)
+
+        if run:
+            if not bottles or (bottles[-1][0].body.position.x > 130 + BOTTLE_SPACING):
+                new_bottle = add_bottle(space)
+                new_bottle[0].body.position = pymunk.Vec2d(130, 300)
+                bottles.append(new_bottle)
+
+        if self.motor:
+            self.conveyor_line_offset = (self.conveyor_line_offset + conveyor_line_speed * self.speed * dt) % 70
+            for idx in range(len(self.wheel_angles)):
+                self.wheel_angles[idx] += wheel_rotation_speed * dt
+        if ( profiler ):
+            profiler.lap("spawn")
+
+        if ( fill_model == "volume" ):
+            self.handle_fill(image, contact, level_sensor)
+        else:
+            self.handle_balls(image, contact, level_sensor)
+
+        if ( self.flag_sensor_level == False ):
+            image[REG_LEVEL] = 0
+        if ( profiler ):
+            profiler.lap("balls")
+
+        # PLC scan: commit outputs
+        scan_start = time.perf_counter()
+        self.commit(image)
+        self.last_image = image
+        if ( self.historian ):
+            self.historian.sample(self.steps, image + snapshot[REG_COUNT:])
+        self.scan_time = scan_time + time.perf_counter() - scan_start
+        self.scan_time_total += self.scan_time
+        self.scan_time_max = max(self.scan_time_max, self.scan_time)
+        if ( profiler ):
+            profiler.lap("plc write")
+
+        # Add/remove bottles from world
+        for bottle in bottles[:]:
+            pos_x = bottle[0].body.position.x
+            screen_pos_x = pos_x * (self.scale or 1.0)
+            if screen_pos_x > self.window_width + 1500 or bottle[0].body.position.y < 150:
+                for segment in bottle:
+                    space.remove(segment)
+                space.remove(bottle[0].body)
+                bottles.remove(bottle)
+                self.fill.pop(bottle[0].body, None)
+        if ( profiler ):
+            profiler.lap("cull")
+
+        step_start = time.perf_counter()
+        space.step(dt)
+        self.step_time = time.perf_counter() - step_start
+        bottles.stepped()
+        if ( profiler ):
+            profiler.lap("space.step")
+        self.sim_time += dt
+        self.steps += 1
+
+    def level_hit(self, image, level_sensor):
+        image[REG_LEVEL] = 1
+        self.flag_sensor_level=True
+        if ( not level_sensor ):
+            self.bottles_filled += 1
+        self.now = self.sim_time
+        delta = self.now - self.now_previous
+        if ( delta > 2 ):
+            self.bottle_per_min = (1*60) / delta
+            self.now_previous = self.now
+
+    def ball_states(self):
+        """ Positions and velocities of all balls as (n, 2) arrays, in the
+        order of self.balls.
+
+        Body data is fetched for the whole space in one batch call and then
+        matched to the balls by body id.
+        """
+        fields = pymunk.batch.BodyFields
+        self.batch.clear()
+        pymunk.batch.get_space_bodies(self.space, fields.BODY_ID | fields.POSITION | fields.VELOCITY, self.batch)
+        ids = np.frombuffer(self.batch.int_buf(), dtype=np.uintp)
+        states = np.frombuffer(self.batch.float_buf(), dtype=np.float64).reshape(-1, 4)
+
+        order = np.argsort(ids)
+        index = order[np.searchsorted(ids, self.ball_ids, sorter=order)]
+        states = states[index]
+        return states[:, 0:2], states[:, 2:4]
+
+    def handle_balls(self, image, contact, level_sensor):
+        balls = self.balls
+        if not balls:
+            return
+
+        position, velocity = self.ball_states()
+        x = position[:, 0]
+        y = position[:, 1]
+
+        # Detect collision with level sensor (in screen coordinates, as to_pygame)
+        if ( contact and not self.flag_sensor_level):
+            screen_x = x.astype(np.int64)
+            screen_y = (600 - y).astype(np.int64)
+            hits = ( (screen_y > level_sensor_y) & (screen_y < level_sensor_y + level_sensor_size)
+                   & (screen_x > level_sensor_x) & (screen_x < level_sensor_x + level_sensor_size)
+                   & (velocity[:, 1] > -100.0) )
+        else:
+            hits = None
+
+        # Remove culled balls in one pass and give them back to the pool
+        culled = (y < 150) | (x > WORLD_SCREEN_WIDTH+150) | (x < -150)
+        if hits is not None and hits.any():
+            self.level_hit(image, level_sensor)
+            # The ball loop stops at the first hit, the balls from it on are culled next step
+            culled[np.argmax(hits):] = False
+        if culled.any():
+            shapes = [balls[i][0] for i in np.flatnonzero(culled)]
+            self.space.remove(*shapes, *[ball.body for ball in shapes])
+            kept = np.flatnonzero(~culled)
+            balls[:] = [balls[i] for i in kept]
+            self.ball_ids = self.ball_ids[kept]
+            self.ball_pool.release(shapes)
+
+    def bottle_at(self, x):
+        """ Bottle whose inside spans world coordinate x, if any. """
+        return self.bottles.find(x + 100 + bottle_thickness, x + 150 - bottle_thickness)
+
+    def fill_top(self, bottle):
+        """ World y of the liquid surface in a bottle (volume fill model). """
+        body = bottle[0].body
+        amount = self.fill.get(body, (0.0, 0))[0]
+        return body.position.y + bottle_thickness + amount * fill_ball_area / fill_inner_width
+
+    def handle_fill(self, image, contact, level_sensor):
+        # Pour the drops that reached the bottles
+        while self.in_flight and self.in_flight[0][0] <= self.sim_time:
+            _, amount, color = self.in_flight.popleft()
+            bottle = self.bottle_at(nozzle_center_x + 1.5)
+            if bottle:
+                fill = self.fill.setdefault(bottle[0].body, [0.0, color])
+                fill[0] += amount
+                fill[1] = color
+
+        # Detect liquid level reaching the level sensor
+        if ( contact and not self.flag_sensor_level):
+            bottle = self.bottle_at(level_sensor_x + level_sensor_size / 2)
+            if bottle and self.fill_top(bottle) >= 600 - level_sensor_y - level_sensor_size:
+                self.level_hit(image, level_sensor)
+
+    def draw_fill(self, screen, scale):
+        rects = []
+        for bottle in self.bottles:
+            fill = self.fill.get(bottle[0].body)
+            if not fill:
+                continue
+            position = bottle[0].body.position
+            top = min(self.fill_top(bottle), position.y + 100)
+            left, top = to_pygame(pymunk.Vec2d(position.x - 150 + bottle_thickness, top), scale)
+            right, bottom = to_pygame(pymunk.Vec2d(position.x - 100 - bottle_thickness, position.y + bottle_thickness), scale)
+            rects.append(pygame.draw.rect(screen, COLORS[fill[1]], pygame.Rect(left, top, right - left, bottom - top)))
+
+        # A few drops falling under the open nozzle
+        if self.nozzle and self.in_flight:
+            bottle = self.bottle_at(nozzle_center_x + 1.5)
+            bottom = self.fill_top(bottle) if bottle else 300
+            drops = []
+            for i in range(fill_particles):
+                phase = (self.sim_time / fill_fall_time + i / fill_particles) % 1.0
+                y = 430 - (430 - bottom) * phase
+                p = to_pygame(pymunk.Vec2d(nozzle_center_x + 1.5, y), scale)
+                drops.append(pygame.draw.circle(screen, COLORS[self.currentColor], p, max(1, int(ball_radius * scale)), 0))
+            rects.append(union_rects(drops))
+        return rects
+
+    def draw(self, screen, scale):
+        """ Draw the moving parts of the plant.
+
+        Returns the screen rects that were drawn on, for dirty-rectangle
+        updates.
+        """
+        rects = []
+
+        # Add laser if needed
+        if not self.contact:
+            rects.append(add_laser(screen, scale))
+
+        # Draw conveyor
+        rects.extend(add_conveyor(screen, self, scale))
+
+        rects.append(union_rects([draw_ball(screen, ball, scale, color=COLORS[ballColor]) for ball, _ , ballColor in self.balls]))
+
+        if ( fill_model == "volume" ):
+            rects.extend(self.draw_fill(screen, scale))
+
+        for bottle in self.bottles:
+            rects.append(draw_lines(screen, bottle, scale, color=colors["line"]))
+
+        return [rect for rect in rects if rect]
+
+class StaticLayers:
+    """ Pre-rendered background of the world view.
+
+    Holds everything that only changes with the window size or the theme
+    (title texts, nozzle, level sensor, conveyor body), in two variants:
+    with and without the level sensor dot.
+    """
+    def __init__(self):
+        self.key = None
+        self.layers = None
+
+    def update(self, plant, size, scale, font):
+        key = (size, scale, dark_mode)
+        if ( key == self.key ):
+            return
+        self.key = key
+        self.layers = [self.build(plant, size, scale, font, level_sensor) for level_sensor in (False, True)]
+
+    def build(self, plant, size, scale, font, show_level_sensor):
+        layer = pygame.Surface(size).convert()
+        layer.fill(colors["bg"])
+
+        if ( not hide_title ):
+            layer.blit(font.render("Bottle-filling factory", 1, colors["title"]), (int(10 * scale), int(10 * scale)))
+            quit_text = font.render("(press Esc to quit)", True, colors["text"])
+            layer.blit(quit_text, (size[0] - quit_text.get_width() - int(10 * scale), int(10 * scale)))
+
+        add_nozzle(layer, scale)
+        if ( show_level_sensor ):
+            add_level_sensor(layer, scale)
+        draw_polygon(layer, plant.nozzle_actuator, scale, color=colors["polygon"])
+        draw_polygon(layer, plant.conveyor, scale, color=colors["polygon"])
+        return layer
+
+    def blit(self, screen, show_level_sensor, rect=None):
+        if ( rect ):
+            screen.blit(self.layers[show_level_sensor], rect, rect)
+        else:
+            screen.blit(self.layers[show_level_sensor], (0, 0))
+
+def is_finished(plant):
+    return plant.end_step is not None and plant.steps >= plant.end_step
+
+def runHeadless(plant):
+    clock = pygame.time.Clock()
+    plant.resize(WORLD_SCREEN_WIDTH, 1.0)
+    if ( plant.recorder ):
+        plant.recorder.resize(plant.steps, WORLD_SCREEN_WIDTH, WORLD_SCREEN_HEIGHT)
+
+    # As fast as possible, each step profiled as a frame
+    if ( time_scale == 0 ):
+        while not is_finished(plant):
+            if ( profiler ):
+                profiler.begin()
+            plant.step()
+            if ( profiler ):
+                profiler.end()
+        return
+
+    while not is_finished(plant):
+        elapsed = clock.tick(min(physics_rate * time_scale, 1000)) / 1000
+        if ( profiler ):
+            profiler.begin()
+        plant.advance(elapsed)
+        if ( profiler ):
+            profiler.end()
+
+def runReplay(path):
+    """ Replay a register trace into a headless plant, as fast as possible.
+
+    The plant gets a private, unserved PLC, the recorded seed and settings,
+    and the recorded register changes and window sizes before the same ticks.
+    """
+    global physics_rate
+    global fill_model
+
+    header, records = read_trace(path)
+    physics_rate = header["physics_rate"]
+    fill_model = header["fill_model"]
+    random.seed(header["seed"])
+
+    plant = Plant(Server())
+    plant.resize(WORLD_SCREEN_WIDTH, 1.0)
+    width = WORLD_SCREEN_WIDTH
+    for tick, addr, value in records:
+        while plant.steps < tick and not is_finished(plant):
+            plant.step()
+        if ( addr == TRACE_END or is_finished(plant) ):
+            break
+        if ( addr == TRACE_WIDTH ):
+            width = value
+        elif ( addr == TRACE_HEIGHT ):
+            plant.resize(width, min(width / WORLD_SCREEN_WIDTH, value / WORLD_SCREEN_HEIGHT))
+        else:
+            plant.plc.write(addr, value)
+    return plant
+
 def runWorld(autorun):
 
-    global conveyor
-    global nozzle_throughput
+    plant = Plant(plc, autorun, recorder=recorder, historian=historian, profiler=profiler)
 
-    # Setup pygame and pymunk
+    if ( headless ):
+        runHeadless(plant)
+        return plant
+
+    # Setup pygame
     pygame.init()
     screen = pygame.display.set_mode((WORLD_SCREEN_WIDTH, WORLD_SCREEN_HEIGHT), pygame.RESIZABLE)
     pygame.display.set_caption("VirtuaPlant - Bottle Filling Simulation")
     icone = pygame.image.load("assets/github_icon.png")
     pygame.display.set_icon(icone)
-    clock = pygame.time.Clock()
-    space = pymunk.Space()
-    space.use_spatial_hash(ball_radius, 10000)
-    space.gravity = (0.0, -900.0)
-
-    nozzle_actuator = add_polygon(space, (181, 450), (15, 20), 0x9)
-    bottles.append(add_bottle(space))
-    balls = []
-
-    now = datetime.now()
-    now_previous = datetime.now()
 
+    clock = pygame.time.Clock()
     running = True
     scale = 1.0
-    bottle_per_min = 0
-
-    #Add pygame events to reduce CPU usage 
-    RESIZE_EVENT = pygame.event.custom_type() 
+    static_layers = StaticLayers()
+    bpm_text = None
+    bpm_key = None
+    drawn = None
+    drawn_rects = []
+    show_profile = profile_overlay
+
+    #Add pygame events to reduce CPU usage
+    RESIZE_EVENT = pygame.event.custom_type()
     pygame.event.set_allowed([QUIT, KEYDOWN, K_ESCAPE, RESIZE_EVENT])
     pygame.time.set_timer(pygame.event.Event(RESIZE_EVENT), 1, 1)
 
-    level_sensor = 0
-    flag_sensor_level=False
-    contact = 0
-    nozzle = 0
-    motor = 0
-    nextColor       = COLORS[0]
-    currentColor    = COLORS[0]  
-    run = autorun
+    while running and not is_finished(plant):
 
-    plc.write(REG_RUN, autorun)
-
-    while running:
-
-        clock.tick(FPS)
+        elapsed = clock.tick(FPS) / 1000
+        if ( profiler ):
+            profiler.begin()
 
         #Handle events
         for event in pygame.event.get():
             if event.type == QUIT or (event.type == KEYDOWN and event.key == K_ESCAPE):
                 running = False
+            if event.type == KEYDOWN and event.key == K_F3 and profiler:
+                show_profile = not show_profile
 
             #Update screen size
-            previous_scale = scale
             if event.type == RESIZE_EVENT:
                 window_width, window_height = screen.get_size()
                 scale_x = window_width / WORLD_SCREEN_WIDTH
@@ -419,139 +1040,67 @@ def runWorld(autorun):
                 fontBig = pygame.font.SysFont(None, int(40 * scale))
                 fontMedium = pygame.font.SysFont(None, int(26 * scale))
 
-                conveyor_width = window_width / scale
-                if ( conveyor == None ):
-                    conveyor = add_polygon(space, (conveyor_width / 2, 300), (conveyor_width, 20), 0x7)
-                if (scale != previous_scale):
-                    space.remove(conveyor)
-                    conveyor = add_polygon(space, (conveyor_width / 2, 300), (conveyor_width, 20), 0x7)
+                plant.resize(window_width, scale)
+                if ( recorder ):
+                    recorder.resize(plant.steps, window_width, window_height)
+                static_layers.update(plant, (window_width, window_height), scale, fontMedium)
 
                 #Debug
                 point = pygame.mouse.get_pos()
                 log.info(point)
-                log.info("balls:" + str(len(balls)) + "bottles:" + str(len(bottles)))
-                log.info ("level=" + str(level_sensor) + " ,contact=" + str(contact) + ", nozzle=" + str(nozzle) + "motor=" + str(motor) + ", run=" + str(run) + ", throughput" + str(nozzle_throughput) + ", currentColor=" + str(currentColor))
+                log.info("balls:" + str(len(plant.balls)) + "bottles:" + str(len(plant.bottles)))
+                log.info ("level=" + str(plant.level_sensor) + " ,contact=" + str(plant.contact) + ", nozzle=" + str(plant.nozzle) + "motor=" + str(plant.motor) + ", run=" + str(plant.run) + ", throughput" + str(plant.throughput) + ", currentColor=" + str(plant.currentColor) + ", scan=" + str(round(plant.scan_time * 1e6)) + "us" + ", pool hits=" + str(plant.ball_pool.hits) + " misses=" + str(plant.ball_pool.misses))
 
                 pygame.time.set_timer(pygame.event.Event(RESIZE_EVENT), 1000, 1)
 
-        #Update Modbus registers
-        run = plc.read(REG_RUN)
-        motor = plc.read(REG_MOTOR_EN)
-        speed = plc.read(REG_MOTOR_SPEED)
-        nozzle = plc.read(REG_NOZZLE)
-        contact = plc.read(REG_CONTACT)
-        level_sensor = plc.read(REG_LEVEL)
-        nozzle_throughput = plc.read(REG_THROUGHPUT)
-        nextColor = plc.read(REG_COLOR)
-
-        # Manage PLC programm
-        # Motor Logic
-        if (run == 1) and ((contact == 0) or (level_sensor == 1)):
-            plc.write(REG_MOTOR_EN, 1)
-        else:
-            plc.write(REG_MOTOR_EN, 0)
+        if ( profiler ):
+            profiler.lap("events")
+        plant.advance(elapsed)
 
-        # Nozzle Logic 
-        if (run == 1) and ((contact == 1) and (level_sensor == 0)):
-            plc.write(REG_NOZZLE, 1)
-        else:
-            plc.write(REG_NOZZLE, 0)
+        # Nothing to draw on until the first resize event
+        if ( static_layers.layers is None ):
+            continue
 
-        if is_sensor_touching_bottle(sensor_x, sensor_y, sensor_radius, bottles):
-            plc.write(REG_CONTACT, 1)
+        # Clear screen with the static elements. In dirty-rects mode only
+        # the areas drawn on during the last frame are cleared.
+        show_level_sensor = not plant.level_sensor
+        full = not dirty_rects or drawn != (static_layers.key, show_level_sensor)
+        if ( full ):
+            static_layers.blit(screen, show_level_sensor)
         else:
-            flag_sensor_level=False
-            plc.write(REG_CONTACT, 0)
-
-        # Clear screen and add static elements
-        screen.fill(colors["bg"])
-        add_nozzle(screen, scale)
-        if ( not level_sensor ):
-            add_level_sensor(screen, scale)
-        draw_polygon(screen, nozzle_actuator, scale, color=colors["polygon"])
+            for rect in drawn_rects:
+                static_layers.blit(screen, show_level_sensor, rect)
+        rects = []
 
-        # Add title and text
+        # Add bottles per minute, rendered again only when it changes
         if ( not hide_title ):
-            screen.blit(fontMedium.render("Bottle-filling factory", 1, colors["title"]), (int(10 * scale), int(10 * scale)))
+            if ( bpm_key != (round(plant.bottle_per_min), fontBig) ):
+                bpm_key = (round(plant.bottle_per_min), fontBig)
+                bpm_text = fontBig.render("Bottles per minute = " + str(bpm_key[0]) , 1, colors["text"])
             title_y = int(10 * scale)
             virtua_y = title_y + fontMedium.get_height() + int(4 * scale)
-            screen.blit(fontBig.render("Bottles per minute = " + str(round(bottle_per_min)) , 1, colors["text"]), (int(10 * scale), virtua_y))
-            quit_text = fontMedium.render("(press Esc to quit)", True, colors["text"])
-            screen.blit(quit_text, (window_width - quit_text.get_width() - int(10 * scale), int(10 * scale)))
+            rects.append(screen.blit(bpm_text, (int(10 * scale), virtua_y)))
 
-        # Handle world inputs
-        if nozzle:
-            if bottles:
-                for i in range(nozzle_throughput):
-                    balls.append((add_ball(space, currentColor), bottles[-1][0].body, currentColor))
-        elif run:
-            currentColor = nextColor
+        rects.extend(plant.draw(screen, scale))
+        if ( profiler ):
+            profiler.lap("draw")
+            if ( show_profile ):
+                rects.append(profiler.draw(screen, int(60 * scale)))
+            profiler.lap("overlay")
 
-        if motor:
-            # Move bottle
-            for bottle in bottles:
-                bottle[0].body.velocity = (20*speed, 0)
+        if ( full ):
+            pygame.display.flip()
         else:
-            for bottle in bottles:
-                bottle[0].body.velocity = (0, 0)
-
-        if run:
-            if not bottles or (bottles[-1][0].body.position.x > 130 + BOTTLE_SPACING):
-                new_bottle = add_bottle(space)
-                new_bottle[0].body.position = pymunk.Vec2d(130, 300)
-                bottles.append(new_bottle)
+            pygame.display.update(drawn_rects + rects)
+        drawn = (static_layers.key, show_level_sensor)
+        drawn_rects = rects
+        if ( profiler ):
+            profiler.lap("flip")
+            profiler.end()
 
-        # Add laser if needed
-        if not contact:
-            add_laser(screen, scale)
-
-        # Draw conveyor 
-        add_conveyor(screen, space, window_width, scale, motor)
-
-        # Handle balls
-        for ball_data in balls[:]:
-            ball, _ , ballColor = ball_data
-
-            # Detect collision with level sensor
-            if ( contact and not flag_sensor_level):
-                x,y = to_pygame(ball.body.position)
-                if ( int(y) > level_sensor_y and int(y) < level_sensor_y + level_sensor_size ):
-                    if ( ( int(x) > level_sensor_x and int(x) < level_sensor_x + level_sensor_size )):
-                        if ( ball.body.velocity.y > -100.0 ):
-                            plc.write(REG_LEVEL, 1)
-                            flag_sensor_level=True
-                            now = datetime.now()
-                            delta = (now - now_previous).total_seconds()
-                            if ( delta > 2 ):
-                                bottle_per_min = (1*60) / delta 
-                                now_previous = now
-                            break
-
-            if ( ball.body.position.y < 150 or ball.body.position.x > WORLD_SCREEN_WIDTH+150 or ball.body.position.x < -150):
-                space.remove(ball, ball.body)
-                balls.remove(ball_data)
-            else:
-                draw_ball(screen, ball, scale, color=COLORS[ballColor])
-
-        if ( flag_sensor_level == False ):
-            plc.write(REG_LEVEL, 0)
+        if ( debug ): pygame.display.set_caption(f"fps: {clock.get_fps():.1f}, scan: {plant.scan_time * 1e6:.0f}us")
 
-        # Add/remove bottles from world
-        for bottle in bottles[:]:
-            pos_x = bottle[0].body.position.x
-            screen_pos_x = pos_x * scale
-            if screen_pos_x > window_width + 1500 or bottle[0].body.position.y < 150:
-                for segment in bottle:
-                    space.remove(segment)
-                space.remove(bottle[0].body)
-                bottles.remove(bottle)
-            else:
-                draw_lines(screen, bottle, scale, color=colors["line"])
-
-        space.step(1 / FPS)
-        pygame.display.flip()
-
-        if ( debug ): pygame.display.set_caption(f"fps: {clock.get_fps()}")
+    return plant
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="The plant")
@@ -563,7 +1112,37 @@ def parse_arguments():
     parser.add_argument("-r", "--run", action='store_true', help="Run plant at startup", default=False)
     parser.add_argument("-D", "--dark", action='store_true', help="Dark mode", default=False)
     parser.add_argument("-H", "--hide_title", action='store_true', help="Hide title", default=False)
-    return parser.parse_args()
+    parser.add_argument("-P", "--physics-rate", type=float, required=False, help="Physics steps per second", default=physics_rate)
+    parser.add_argument("--fps", type=float, required=False, help="Display frames per second", default=FPS)
+    parser.add_argument("--max-substeps", type=int, required=False, help="Max physics steps per frame", default=max_substeps)
+    parser.add_argument("-T", "--time-scale", type=float, required=False, help="Simulated seconds per wall second (0 = as fast as possible, headless only)", default=time_scale)
+    parser.add_argument("--duration", type=float, required=False, help="Simulated seconds to run before exiting", default=None)
+    parser.add_argument("-A", "--async-server", action='store_true', help="Serve Modbus clients from an asyncio event loop", default=False)
+    parser.add_argument("-F", "--fill-model", choices=["balls", "volume"], required=False, help="Simulate liquid as balls or as a volume per bottle", default=fill_model)
+    parser.add_argument("-R", "--dirty-rects", action='store_true', help="Only update the screen areas that changed", default=False)
+    parser.add_argument("--headless", action='store_true', help="Run physics and PLC without display", default=False)
+    parser.add_argument("--seed", type=int, required=False, help="Seed of the simulation, for reproducible runs", default=None)
+    parser.add_argument("--record", metavar="TRACE", required=False, help="Record the external register writes to a trace file", default=None)
+    parser.add_argument("--replay", metavar="TRACE", required=False, help="Replay a trace file headless, as fast as possible", default=None)
+    parser.add_argument("--historian", metavar="FILE", required=False, help="Record the register block every scan to a history file", default=None)
+    parser.add_argument("--profile", metavar="SECONDS", type=float, nargs="?", const=5.0, required=False, help="Time each phase of the frames and print a summary every SECONDS (default 5, 0 = only at exit)", default=None)
+    parser.add_argument("--profile-overlay", action='store_true', help="Show the frame profile over the plant, F3 toggles it (implies --profile)", default=False)
+    args = parser.parse_args()
+    if ( args.time_scale < 0 ):
+        parser.error("--time-scale must be positive")
+    if ( args.time_scale == 0 and not args.headless ):
+        parser.error("--time-scale 0 is only available with --headless")
+    return args
+
+def report(plant, wall):
+    print(f"Simulated {plant.sim_time:.1f}s in {wall:.1f}s ({plant.sim_time / wall:.1f}x), "
+          f"{plant.steps} steps, {plant.bottles_filled} bottles filled")
+    if ( plant.steps ):
+        print(f"Ball pool: {plant.ball_pool.hits} hits, {plant.ball_pool.misses} misses")
+        print(f"PLC scan time: mean {plant.scan_time_total / plant.steps * 1e6:.1f}us, "
+              f"max {plant.scan_time_max * 1e6:.1f}us")
+    if ( plant.profiler ):
+        print(plant.profiler.line())
 
 def main():
     global plc
@@ -573,6 +1152,18 @@ def main():
     global debug
     global nozzle_throughput
     global hide_title
+    global headless
+    global physics_rate
+    global max_substeps
+    global FPS
+    global time_scale
+    global duration
+    global fill_model
+    global dirty_rects
+    global recorder
+    global historian
+    global profiler
+    global profile_overlay
 
     # Arguments
     args = parse_arguments()
@@ -584,22 +1175,64 @@ def main():
     autorun = args.run
     dark_mode = args.dark
     debug = args.debug
+    headless = args.headless
+    physics_rate = args.physics_rate
+    max_substeps = args.max_substeps
+    FPS = args.fps
+    time_scale = args.time_scale
+    duration = args.duration
+    fill_model = args.fill_model
+    dirty_rects = args.dirty_rects
     log.setLevel(logging.WARNING)
     if ( debug ):
         log.setLevel(logging.INFO)
 
     colors = get_theme_colors()
 
+    start = time.perf_counter()
+    if ( args.replay ):
+        headless = True
+        plant = runReplay(args.replay)
+        report(plant, time.perf_counter() - start)
+        return
+
+    # Seeded runs are reproducible from the trace of their register writes
+    seed = args.seed
+    if ( seed is None and args.record ):
+        seed = random.randrange(2**32)
+    if ( seed is not None ):
+        random.seed(seed)
+    if ( args.record ):
+        recorder = TraceWriter(args.record, {"seed": seed, "physics_rate": physics_rate, "fill_model": fill_model})
+    if ( args.historian ):
+        historian = Historian(args.historian, physics_rate)
+    profile_overlay = args.profile_overlay
+    if ( args.profile is not None or profile_overlay ):
+        profiler = FrameProfiler(interval=5.0 if args.profile is None else args.profile)
+
     # Initialise plc component
-    plc = Server(ip, port)
+    plc = Server(ip, port, asynchronous=args.async_server)
     run_servers()  
     log.info("Modbus server started")
     plc.write(REG_THROUGHPUT, nozzle_throughput)
     plc.write(REG_MOTOR_SPEED, speed)
 
     # Run World
-    runWorld(autorun)    
+    try:
+        plant = runWorld(autorun)
+    except KeyboardInterrupt:
+        plant = None
+    finally:
+        if ( recorder ):
+            recorder.close()
+        if ( historian ):
+            historian.close()
     pygame.quit()
 
+    if ( plant and headless ):
+        report(plant, time.perf_counter() - start)
+    elif ( profiler ):
+        print(profiler.line())
+
 if __name__ == "__main__":
     main()